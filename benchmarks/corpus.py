@@ -0,0 +1,39 @@
+import random
+import string
+
+TLDS = ["com", "net", "org", "io", "vn", "co", "de", "jp", "info", "xyz"]
+SUBDOMAIN_LABELS = ["ads", "cdn", "track", "metrics", "api", "log", "pixel", "static", "s", "img"]
+
+def random_label(rng, min_length=3, max_length=12):
+    alphabet = string.ascii_lowercase + string.digits
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(min_length, max_length)))
+
+def generate_domains(count, subdomain_ratio=0.5, seed=0):
+    rng = random.Random(seed)
+    base_count = max(1, int(count * (1 - subdomain_ratio)))
+    # Only half of the registrable domains are listed themselves, the rest
+    # appear through their subdomains alone
+    bases = [f"{random_label(rng)}.{rng.choice(TLDS)}" for _ in range(base_count * 2)]
+    domains = bases[:base_count]
+    while len(domains) < count:
+        depth = rng.randint(1, 3)
+        labels = [
+            rng.choice(SUBDOMAIN_LABELS) if rng.random() < 0.5 else random_label(rng, 1, 8)
+            for _ in range(depth)
+        ]
+        domains.append(".".join(labels + [rng.choice(bases)]))
+    return domains
+
+def generate_lines(domains, fmt, seed=0, comment_ratio=0.05, idn_ratio=0.01):
+    rng = random.Random(seed)
+    for domain in domains:
+        if rng.random() < comment_ratio:
+            yield "! comment" if fmt == "adblock" else "# comment"
+        if rng.random() < idn_ratio:
+            domain = f"xn--{domain}" if rng.random() < 0.5 else f"bücher-{domain}"
+        if fmt == "hosts":
+            yield f"0.0.0.0 {domain}"
+        elif fmt == "adblock":
+            yield f"||{domain}^"
+        else:
+            yield domain
@@ -0,0 +1,70 @@
+import time
+import logging
+import argparse
+import tracemalloc
+from benchmarks.corpus import generate_domains
+from src import convert
+from src.domainset import DomainSet
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+def legacy_domain_list(block_domains, white_domains):
+    # convert_to_domain_list before it returned a DomainSet
+    white_keys = {convert.domain_to_key(domain) for domain in white_domains}
+    final_keys = convert.collapse_subdomains(convert.domain_keys(block_domains, white_keys), white_keys)
+    return [key[-2::-1] for key in final_keys]
+
+def main():
+    parser = argparse.ArgumentParser(description="DomainSet memory and speed benchmark")
+    parser.add_argument("--size", type=int, default=1_000_000, help="Number of blocked domains")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    block_domains = set(generate_domains(args.size))
+    white_domains = set(generate_domains(args.size // 100, seed=1))
+    print(f"Corpus: {len(block_domains)} blocked, {len(white_domains)} whitelisted")
+
+    results = []
+    for name, func in (("list[str]", legacy_domain_list), ("DomainSet", convert.convert_to_domain_list)):
+        result, elapsed, current, peak = measure(func, block_domains, white_domains)
+        results.append(list(result))
+        print(
+            f"{name:10s} build {elapsed:6.3f}s  retained {current / 2**20:7.1f} MiB  "
+            f"peak {peak / 2**20:7.1f} MiB  {len(result)} domains"
+        )
+
+    assert results[0] == results[1], "DomainSet order or contents differ from the list"
+    del results
+
+    domains = convert.convert_to_domain_list(block_domains, white_domains)
+    probes = list(block_domains)[:10000]
+
+    start = time.perf_counter()
+    chunks = sum(1 for chunk in domains.chunks(1000))
+    print(f"chunks(1000)        {time.perf_counter() - start:6.3f}s  {chunks} chunks")
+
+    start = time.perf_counter()
+    found = sum(1 for domain in probes if domain in domains)
+    print(f"10k membership      {time.perf_counter() - start:6.3f}s  {found} found")
+
+    start = time.perf_counter()
+    updated = domains.update_keys(
+        [convert.domain_to_key(f"new{i}.example") for i in range(1000)],
+        [convert.domain_to_key(domain) for domain in probes[:1000]],
+    )
+    print(f"update_keys(+1k-1k) {time.perf_counter() - start:6.3f}s  {len(updated)} domains")
+
+    other = DomainSet.from_domains(probes)
+    start = time.perf_counter()
+    difference = domains - other
+    print(f"difference (merge)  {time.perf_counter() - start:6.3f}s  {len(difference)} domains")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import time
+import logging
+import argparse
+from benchmarks.corpus import generate_domains, generate_lines
+from src import convert, replace_pattern, domain_pattern, ip_pattern
+
+def legacy_extract_domains(lines, domains):
+    # extract_domains before the plain-domain fast path, every line went
+    # through the regex and IDNA codec
+    for line in lines:
+        if line.startswith(("#", "!", "/")) or line == "":
+            continue
+
+        cleaned_line = line.lower().strip().split("#")[0].split("^")[0].replace("\r", "")
+        domain = replace_pattern.sub("", cleaned_line, count=1)
+        try:
+            domain = domain.encode("idna").decode("utf-8", "replace")
+            if domain_pattern.match(domain) and not ip_pattern.match(domain):
+                domains.add(domain)
+        except Exception:
+            pass
+
+def best_of(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        domains = set()
+        start = time.perf_counter()
+        func(lines, domains)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, domains
+
+def main():
+    parser = argparse.ArgumentParser(description="extract_domains micro-benchmark")
+    parser.add_argument("--lines", type=int, default=500_000, help="Number of source lines per format")
+    parser.add_argument("--formats", nargs="+", choices=["hosts", "adblock", "plain"], default=["hosts", "adblock", "plain"])
+    parser.add_argument("--idn-ratio", type=float, default=0.01, help="Share of internationalized domains")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    domains = generate_domains(args.lines)
+    for fmt in args.formats:
+        lines = list(generate_lines(domains, fmt, idn_ratio=args.idn_ratio))
+        legacy_time, legacy = best_of(legacy_extract_domains, lines, args.repeat)
+        fast_time, fast = best_of(convert.extract_domains, lines, args.repeat)
+        assert fast == legacy, f"{fmt}: fast path output differs from the legacy parser"
+        print(
+            f"{fmt:8s} {len(lines):8d} lines  legacy {legacy_time:7.3f}s  "
+            f"fast {fast_time:7.3f}s  speedup {legacy_time / fast_time:5.2f}x  {len(fast)} domains"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import os
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.corpus import generate_domains, generate_lines
+from src import convert
+
+def main():
+    parser = argparse.ArgumentParser(description="extract_domains process pool scaling benchmark")
+    parser.add_argument("--lines", type=int, default=1_000_000, help="Number of source lines")
+    parser.add_argument("--format", choices=["hosts", "adblock", "plain"], default="hosts")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    lines = list(generate_lines(generate_domains(args.lines), args.format))
+    print(f"Corpus: {len(lines)} {args.format} lines, {os.cpu_count()} CPUs")
+
+    start = time.perf_counter()
+    serial = set()
+    convert.extract_domains(lines, serial)
+    serial_time = time.perf_counter() - start
+    print(f"serial      {serial_time:7.3f}s  {len(serial)} domains")
+
+    for workers in args.workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Warm the pool up so process start-up is not part of the timing
+            list(executor.map(convert.extract_batch, [""] * workers))
+            start = time.perf_counter()
+            parallel = set()
+            convert.extract_domains_parallel(lines, parallel, executor, max_pending=2 * workers)
+            elapsed = time.perf_counter() - start
+        assert parallel == serial, "parallel output differs from the serial path"
+        print(f"{workers:2d} workers  {elapsed:7.3f}s  speedup {serial_time / elapsed:5.2f}x")
+
+if __name__ == "__main__":
+    main()
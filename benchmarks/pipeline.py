@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from benchmarks.corpus import generate_domains, generate_lines
+from src import convert, utils, requests, mock, MAX_LISTS, MAX_LIST_SIZE
+from src.state import Manifest
+from src.domainset import DomainSet
+from src.__main__ import CloudflareManager
+
+def measure(func, *args, repeat=3):
+    # Best wall time of `repeat` plain runs, then one more run under
+    # tracemalloc for the peak, which would otherwise skew the timings
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"seconds": best, "peak_bytes": peak}
+
+def extract(lines):
+    domains = set()
+    convert.extract_domains(lines, domains)
+    return domains
+
+def hash_chunks(chunks):
+    # The per-list hashes plan() compares against the remote lists
+    return [utils.hash_list(chunk) for chunk in chunks]
+
+def bench_parse(size, formats, repeat):
+    domains = generate_domains(size)
+    white_domains = set(generate_domains(max(1, size // 100), seed=1))
+    results = {}
+    block_domains = None
+    for fmt in formats:
+        lines = list(generate_lines(domains, fmt))
+        parsed, stats = measure(extract, lines, repeat=repeat)
+        results[f"extract_domains.{fmt}"] = {**stats, "lines": len(lines), "domains": len(parsed)}
+        block_domains = block_domains or parsed
+
+    collapsed, stats = measure(convert.remove_subdomains_if_higher, block_domains, repeat=repeat)
+    results["remove_subdomains_if_higher"] = {**stats, "domains": len(collapsed)}
+    domain_list, stats = measure(convert.convert_to_domain_list, block_domains, white_domains, repeat=repeat)
+    results["convert_to_domain_list"] = {**stats, "domains": len(domain_list)}
+    chunks, stats = measure(utils.split_domain_list, domain_list, repeat=repeat)
+    results["split_domain_list"] = {**stats, "chunks": len(chunks)}
+    hashes, stats = measure(hash_chunks, chunks, repeat=repeat)
+    results["hash_list"] = {**stats, "chunks": len(hashes)}
+    return results
+
+def bench_sync(size, churn, cache_dir):
+    # Replays CloudflareManager.run against the mock Gateway API: a first
+    # sync into an empty account, a sync without changes and one after
+    # `churn` of the domains were replaced
+    gateway = mock.MockGateway().start()
+    requests.client = requests.CloudflareClient(
+        "bench", "bench", gateway.url, limiter=requests.RateLimiter(1000, 1000, 1000, 1000)
+    )
+    manager = CloudflareManager("Bench", MAX_LISTS, MAX_LIST_SIZE)
+    manager.manifest = Manifest(os.path.join(cache_dir, "manifest.json"))
+
+    domains = generate_domains(size)
+    rng = random.Random(0)
+    changed = list(domains)
+    for index in rng.sample(range(len(changed)), int(len(changed) * churn)):
+        changed[index] = f"churn{index}.example"
+
+    results = {}
+    try:
+        for scenario, scenario_domains in (("initial", domains), ("noop", domains), ("churn", changed)):
+            domain_list = DomainSet.from_domains(scenario_domains)
+            manager.build_domain_list = lambda use_cache=True: domain_list
+            gateway.requests.clear()
+            gateway.bytes_in = gateway.bytes_out = 0
+            start = time.perf_counter()
+            manager.run()
+            results[scenario] = {
+                "seconds": time.perf_counter() - start,
+                "domains": len(domain_list),
+                "requests": sum(gateway.requests.values()),
+                "bytes_out": gateway.bytes_in,
+                "bytes_in": gateway.bytes_out,
+                "endpoints": {f"{method} {endpoint}": count for (method, endpoint), count in gateway.requests.items()},
+            }
+    finally:
+        gateway.stop()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse and sync pipeline benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Corpus sizes in lines")
+    parser.add_argument("--formats", nargs="+", choices=["hosts", "adblock", "plain"], default=["hosts", "adblock", "plain"])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sync-size", type=int, default=100_000, help="Domains in the replayed sync (0 to skip it)")
+    parser.add_argument("--churn", type=float, default=0.01, help="Share of domains replaced before the last sync")
+    parser.add_argument("--output", default="-", help="Write the JSON results here ('-' for stdout)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "parse": {},
+    }
+    for size in args.sizes:
+        print(f"Parsing {size} lines", file=sys.stderr)
+        report["parse"][str(size)] = bench_parse(size, args.formats, args.repeat)
+    if args.sync_size:
+        print(f"Replaying a sync of {args.sync_size} domains", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            report["sync"] = bench_sync(min(args.sync_size, MAX_LISTS * MAX_LIST_SIZE), args.churn, cache_dir)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(data)
+    else:
+        with open(args.output, "w") as f:
+            f.write(data)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import time
+import logging
+import argparse
+from src import mock, requests, cloudflare, CIRCUIT_BREAKER_THRESHOLD
+from src.metrics import metrics
+
+def call(client):
+    # One request without retries, so every breaker transition is visible
+    try:
+        client.request("GET", "/lists")
+        return "ok"
+    except requests.CircuitOpenError:
+        return "open"
+    except requests.HTTPException as e:
+        return e.status
+
+def check_breaker(threshold, cooldown):
+    # Drives one client's circuit breaker through every state against the
+    # mock Gateway API: opened by an outage, a half-open trial answered
+    # with 429, then recovery once the API is healthy again
+    gateway = mock.MockGateway(retry_after=0).start()
+    client = requests.CloudflareClient(
+        "bench", "bench", gateway.url, limiter=requests.RateLimiter(1000, 1000, 1000, 1000)
+    )
+    client.breaker = requests.CircuitBreaker(threshold, cooldown)
+    steps = []
+    try:
+        gateway.outage = 1.0
+        steps += [("outage", call(client)) for _ in range(threshold)]
+        steps.append(("while open", call(client)))
+        time.sleep(cooldown)
+        gateway.outage = 0.0
+        gateway.throttle = 1.0
+        steps.append(("trial throttled", call(client)))
+        gateway.throttle = 0.0
+        steps.append(("healthy", call(client)))
+        steps.append(("healthy", call(client)))
+    finally:
+        gateway.stop()
+
+    expected = [("outage", 503)] * threshold + [
+        ("while open", "open"), ("trial throttled", 429), ("healthy", "ok"), ("healthy", "ok"),
+    ]
+    assert steps == expected, f"circuit breaker went {steps}"
+    assert client.breaker.trips == 1
+    return steps
+
+def retry_outage(outage, calls):
+    # Calls through the retry policy while a share of responses are 503s
+    gateway = mock.MockGateway(outage=outage, seed=1).start()
+    client = requests.CloudflareClient(
+        "bench", "bench", gateway.url, limiter=requests.RateLimiter(1000, 1000, 1000, 1000)
+    )
+    requests.retry_budget.reset()
+    metrics.reset()
+    start = time.perf_counter()
+    failed = 0
+    try:
+        with requests.use_client(client):
+            for _ in range(calls):
+                try:
+                    cloudflare.get_current_lists()
+                except requests.HTTPException:
+                    failed += 1
+    finally:
+        gateway.stop()
+    retries = metrics.report()["retries"]
+    return time.perf_counter() - start, failed, retries
+
+def main():
+    parser = argparse.ArgumentParser(description="Retry policy and circuit breaker checks against the mock Gateway API")
+    parser.add_argument("--cooldown", type=float, default=0.5, help="Circuit breaker cooldown used by the check")
+    parser.add_argument("--outage", type=float, nargs="+", default=[0.1, 0.3])
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for name, result in check_breaker(CIRCUIT_BREAKER_THRESHOLD, args.cooldown):
+        print(f"{name:16s} {result}")
+    for outage in args.outage:
+        elapsed, failed, retries = retry_outage(outage, args.calls)
+        print(
+            f"outage {outage:4.0%}  {args.calls} calls {elapsed:6.2f}s  {failed} failed  "
+            f"{retries['count']} retries  {retries['sleep_seconds']:.1f}s sleeping  {retries['gave_up']} gave up"
+        )
+
+if __name__ == "__main__":
+    main()
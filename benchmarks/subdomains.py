@@ -0,0 +1,60 @@
+import time
+import logging
+import argparse
+from benchmarks.corpus import generate_domains
+from src import convert
+
+def legacy_remove_subdomains_if_higher(domains):
+    top_level_domains = set()
+    for domain in domains:
+        parts = domain.split(".")
+        is_lower_subdomain = False
+        for i in range(1, len(parts)):
+            if ".".join(parts[i:]) in domains:
+                is_lower_subdomain = True
+                break
+        if not is_lower_subdomain:
+            top_level_domains.add(domain)
+    return top_level_domains
+
+def legacy_convert_to_domain_list(block_domains, white_domains):
+    return sorted(list(legacy_remove_subdomains_if_higher(block_domains) - white_domains))
+
+def timed(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser(description="Subdomain collapsing benchmark")
+    parser.add_argument("--size", type=int, default=1_000_000, help="Number of blocked domains")
+    parser.add_argument("--whitelist", type=int, default=10_000, help="Number of whitelisted domains")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    block_domains = set(generate_domains(args.size))
+    # Whitelist a mix of unrelated domains and unlisted parents of blocked subdomains
+    parents = {
+        domain.split(".", 1)[1] for domain in block_domains if domain.count(".") > 1
+    }
+    parents = set(list(parents - block_domains)[:args.whitelist])
+    white_domains = set(generate_domains(args.whitelist, seed=1)) | parents
+    print(f"Corpus: {len(block_domains)} blocked, {len(white_domains)} whitelisted")
+
+    legacy, legacy_time = timed(legacy_remove_subdomains_if_higher, block_domains)
+    current, current_time = timed(convert.remove_subdomains_if_higher, block_domains)
+    assert legacy == current, "collapsed sets differ"
+    print(f"remove_subdomains_if_higher  legacy {legacy_time:7.3f}s  sorted index {current_time:7.3f}s")
+
+    legacy, legacy_time = timed(legacy_convert_to_domain_list, block_domains, white_domains)
+    current, current_time = timed(convert.convert_to_domain_list, block_domains, white_domains)
+    print(
+        f"convert_to_domain_list       legacy {legacy_time:7.3f}s  sorted index {current_time:7.3f}s"
+        f"  ({len(legacy)} exact, {len(current)} suffix-aware)"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,28 @@ from functools import wraps
 # Constants
 MAX_LISTS = 300
 MAX_LIST_SIZE = 1000
-RATE_LIMIT_INTERVAL = 1.0
+RATE_LIMIT = 1.0
+RATE_LIMIT_MAX = 4.0
+RATE_LIMIT_MIN = 0.1
+RATE_LIMIT_BURST = 4
+CONNECTION_POOL_SIZE = 8
+CLOUDFLARE_WORKERS = 8
 PREFIX = "AdBlock-DNS-Filters"
+WHITELIST_SUBDOMAINS = True
+DOWNLOAD_WORKERS = 8
+PARSE_WORKERS = 0
+PARSE_BATCH_SIZE = 50000
+DOWNLOAD_TIMEOUT = 60
+CACHE_DIR = ".cache"
+DOWNLOAD_CACHE_SIZE = 512 * 1024 * 1024
+PARSED_CACHE_SIZE = 256 * 1024 * 1024
+SYNC_TIME_BUDGET = 0
+SERVE_INTERVAL = 300
+RETRY_MAX_ATTEMPTS = 8
+RETRY_CALL_TIMEOUT = 120
+RETRY_BUDGET = 200
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30
 
 # Read .env variables 
 def dot_env(file_path=".env"):
@@ -32,8 +52,31 @@ env_vars = dot_env()
 # Load environment or .env variables
 CF_API_TOKEN = os.getenv("CF_API_TOKEN") or env_vars.get("CF_API_TOKEN")
 CF_IDENTIFIER = os.getenv("CF_IDENTIFIER") or env_vars.get("CF_IDENTIFIER")
-if not CF_API_TOKEN or not CF_IDENTIFIER:
-    raise Exception("Missing Cloudflare credentials")
+CF_API_URL = os.getenv("CF_API_URL") or env_vars.get("CF_API_URL") or "https://api.cloudflare.com"
+CF_TARGETS = os.getenv("CF_TARGETS") or env_vars.get("CF_TARGETS")
+
+def env_int(key, default):
+    value = os.getenv(key) or env_vars.get(key)
+    return int(value) if value else default
+
+def env_float(key, default):
+    value = os.getenv(key) or env_vars.get(key)
+    return float(value) if value else default
+
+DOWNLOAD_WORKERS = env_int("DOWNLOAD_WORKERS", DOWNLOAD_WORKERS)
+DOWNLOAD_TIMEOUT = env_float("DOWNLOAD_TIMEOUT", DOWNLOAD_TIMEOUT)
+CLOUDFLARE_WORKERS = env_int("CLOUDFLARE_WORKERS", CLOUDFLARE_WORKERS)
+PARSE_WORKERS = env_int("PARSE_WORKERS", PARSE_WORKERS)
+CACHE_DIR = os.getenv("CACHE_DIR") or env_vars.get("CACHE_DIR") or CACHE_DIR
+DOWNLOAD_CACHE_SIZE = env_int("DOWNLOAD_CACHE_SIZE", DOWNLOAD_CACHE_SIZE)
+PARSED_CACHE_SIZE = env_int("PARSED_CACHE_SIZE", PARSED_CACHE_SIZE)
+SYNC_TIME_BUDGET = env_float("SYNC_TIME_BUDGET", SYNC_TIME_BUDGET)
+SERVE_INTERVAL = env_float("SERVE_INTERVAL", SERVE_INTERVAL)
+RETRY_MAX_ATTEMPTS = env_int("RETRY_MAX_ATTEMPTS", RETRY_MAX_ATTEMPTS)
+RETRY_CALL_TIMEOUT = env_float("RETRY_CALL_TIMEOUT", RETRY_CALL_TIMEOUT)
+RETRY_BUDGET = env_int("RETRY_BUDGET", RETRY_BUDGET)
+CIRCUIT_BREAKER_THRESHOLD = env_int("CIRCUIT_BREAKER_THRESHOLD", CIRCUIT_BREAKER_THRESHOLD)
+CIRCUIT_BREAKER_COOLDOWN = env_float("CIRCUIT_BREAKER_COOLDOWN", CIRCUIT_BREAKER_COOLDOWN)
 
 # Compile regex patterns
 replace_pattern = re.compile(
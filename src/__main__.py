@@ -1,113 +1,307 @@
-import re
+import os
+import time
+import signal
+import threading
 import argparse
+import contextvars
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, Future
+from src.state import Manifest
+from src.targets import load_targets
+from src.metrics import metrics, ThreadProfiler
 from src import (
     info, error, silent_error,
-    utils, domains, cloudflare, 
-    PREFIX, MAX_LISTS, MAX_LIST_SIZE,
+    utils, domains, cloudflare, requests, mock,
+    PREFIX, MAX_LISTS, MAX_LIST_SIZE, CACHE_DIR, CF_API_TOKEN, CF_IDENTIFIER, SYNC_TIME_BUDGET,
+    SERVE_INTERVAL, CF_TARGETS,
 )
 
-class CloudflareManager:
-    def __init__(self, prefix, max_lists, max_list_size):
+class Syncer:
+    # What a single manager and a fleet of them share: building the domain
+    # list and the serve loop around their sync()
+    def __init__(self):
+        self.deadline = None
+        self.converter = None
+        self.stopping = threading.Event()
+
+    def build_domain_list(self, use_cache=True):
+        if self.converter is None:
+            self.converter = domains.DomainConverter(use_cache=use_cache)
+        else:
+            self.converter.reload_urls()
+        return self.converter.process_urls()
+
+    def serve(self, interval, use_cache=True, verify=False, time_budget=0):
+        info(f"Serving, syncing every {interval:.0f}s")
+        while not self.stopping.is_set():
+            start = time.monotonic()
+            self.deadline = start + time_budget if time_budget else None
+            requests.retry_budget.reset(self.deadline)
+            try:
+                with metrics.phase("manager.sync"):
+                    self.sync(use_cache, verify)
+            except (Exception, SystemExit) as e:
+                # A failed cycle is retried in full on the next one, even
+                # when plan() gave up on it through error()
+                silent_error(f"Sync failed: {e}")
+            elapsed = time.monotonic() - start
+            info(f"Sync took {elapsed:.1f}s, next one in {max(0, interval - elapsed):.0f}s")
+            self.stopping.wait(max(0, interval - elapsed))
+        info("Stopped serving")
+
+class CloudflareManager(Syncer):
+    def __init__(self, prefix, max_lists, max_list_size, client=None):
+        super().__init__()
         self.prefix = prefix
         self.max_lists = max_lists
         self.max_list_size = max_list_size
+        self.client = client or requests.client
         self.adlist_name = f"[{self.prefix}]"
         self.policy_name = f"[{self.prefix}] Block Ads"
+        self.manifest = Manifest(
+            os.path.join(CACHE_DIR, f"manifest-{self.client.account_id}-{self.prefix}.json")
+        )
+        self.synced_list = None
 
-    def run(self):
-        converter = domains.DomainConverter()
-        domain_list = converter.process_urls()
-        total_lines = len(domain_list)
-
-        if (total_lines == 0):
-            silent_error("No domain")
-            return
-
-        if total_lines > (self.max_list_size * self.max_lists):
-            error(f"The domains list has more than {self.max_list_size * self.max_lists} lines")
-            return
-
-        total_lists = total_lines // self.max_list_size
+    @metrics.timed("manager.fetch_remote_state")
+    def fetch_remote_state(self, verify=False):
+        # Everything plan() needs from Cloudflare. It does not depend on the
+        # domain list, so it runs while the sources are downloaded.
         current_lists = cloudflare.get_current_lists()
         current_policies = cloudflare.get_current_policies()
-        current_lists.sort(key=utils.safe_sort_key)
+        current_lists.sort(key=lambda list_item: utils.safe_sort_key(list_item, self.adlist_name))
 
         info(f"Total lists on Cloudflare: {len(current_lists)}")
         total_domains = sum([l['count'] for l in current_lists]) if current_lists else 0
         info(f"Total domains on Cloudflare: {total_domains}")
 
         current_lists_with_prefix = [
-            list_item for list_item in current_lists if self.prefix in list_item["name"]
+            list_item for list_item in current_lists
+            if utils.list_index(self.adlist_name, list_item["name"]) is not None
         ]
-        current_lists_count = len(current_lists_with_prefix)
-        current_lists_count_without_prefix = len(current_lists) - current_lists_count
 
-        if total_lines == sum([l['count'] for l in current_lists_with_prefix]):
-            silent_error("Same size, skipping")
-            return
+        excess_lists = []
+        existing_lists = {}
+        for list_item in current_lists_with_prefix:
+            list_index = utils.list_index(self.adlist_name, list_item["name"])
+            if list_index in existing_lists:
+                excess_lists.append(list_item)
+            else:
+                existing_lists[list_index] = list_item
+
+        current_chunks = {}
+        if not verify:
+            # Read from disk once. After that apply() keeps the in-memory
+            # lists current, so serve cycles don't re-read and replay them.
+            if not self.manifest.loaded:
+                self.manifest.load()
+            for list_index, list_item in existing_lists.items():
+                trusted_items = self.manifest.trusted_items(list_item)
+                if trusted_items is not None:
+                    current_chunks[list_index] = trusted_items
+
+        unknown_lists = {
+            list_index: list_item for list_index, list_item in existing_lists.items()
+            if list_index not in current_chunks
+        }
+        info(
+            f"Reading {len(unknown_lists)} lists from Cloudflare, "
+            f"{len(current_chunks)} trusted from the local manifest"
+        )
+        remote_items = cloudflare.get_lists_items([
+            list_item["id"] for list_item in unknown_lists.values()
+        ])
+        for list_index, list_item in unknown_lists.items():
+            current_chunks[list_index] = [item["value"] for item in remote_items[list_item["id"]]]
+
+        policy = next(
+            (policy_item for policy_item in current_policies if policy_item["name"] == self.policy_name),
+            None,
+        )
+
+        return {
+            "other_lists_count": len(current_lists) - len(current_lists_with_prefix),
+            "existing_lists": existing_lists,
+            "excess_lists": excess_lists,
+            "current_chunks": current_chunks,
+            "policy": policy,
+        }
+
+    @metrics.timed("manager.plan")
+    def plan(self, domain_list, remote_state):
+        total_lines = len(domain_list)
+
+        if (total_lines == 0):
+            silent_error("No domain")
+            return None
+
+        if total_lines > (self.max_list_size * self.max_lists):
+            error(f"The domains list has more than {self.max_list_size * self.max_lists} lines")
+            return None
 
-        if total_lists > self.max_lists - current_lists_count_without_prefix:
+        total_lists = total_lines // self.max_list_size
+        max_lists_available = self.max_lists - remote_state["other_lists_count"]
+        if total_lists > max_lists_available:
             error(
                 f"The number of lists required ({total_lists}) is greater than the maximum allowed "
-                f"({self.max_lists - current_lists_count_without_prefix})"
+                f"({max_lists_available})"
             )
-            return
+            return None
 
-        chunked_lists = utils.split_domain_list(domain_list)
+        existing_lists = remote_state["existing_lists"]
+        excess_lists = list(remote_state["excess_lists"])
+        current_chunks = remote_state["current_chunks"]
+
+        chunked_lists = utils.assign_domain_list(domain_list, current_chunks)
+        if len(chunked_lists) > max_lists_available:
+            info("Keeping the current assignment needs too many lists, repacking all lists")
+            chunked_lists = dict(enumerate(utils.split_domain_list(domain_list), start=1))
         info(f"Total chunked lists generated: {len(chunked_lists)}")
 
         used_list_ids = []
-        excess_list_ids = []
-        existing_indices = [
-            int(re.search(r'\d+', list_item["name"]).group())
-            for list_item in current_lists_with_prefix
-        ]
-        total_lists = len(chunked_lists)
-        missing_indices = utils.get_missing_indices(existing_indices, total_lists)
-
-        for list_item in current_lists_with_prefix:
-            list_index = int(re.search(r'\d+', list_item["name"]).group())
-            if list_index in existing_indices and list_index - 1 < len(chunked_lists):
-                list_items = cloudflare.get_list_items(list_item["id"])
-                list_items_values = [item["value"] for item in list_items]
-                new_list_items = chunked_lists[list_index - 1]
-
-                if utils.hash_list(new_list_items) == utils.hash_list(list_items_values):
-                    info(f"No changes detected for list {list_item['name']}, skipping update")
-                    used_list_ids.append(list_item["id"])
-                else:
-                    info(f"Updating list {list_item['name']}")
-                    list_items_array = [{"value": domain} for domain in new_list_items]
-
-                    payload = {
-                        "append": list_items_array,
-                        "remove": list_items_values,
-                    }
-
-                    cloudflare.patch_list(list_item["id"], payload)
-                    used_list_ids.append(list_item["id"])
+        patches = []
+        for list_index, list_item in existing_lists.items():
+            if list_index in chunked_lists:
+                list_items_values = current_chunks[list_index]
+                new_list_items = chunked_lists[list_index]
+                if utils.hash_list(new_list_items) != utils.hash_list(list_items_values):
+                    payload = utils.create_patch_payload(list_items_values, new_list_items)
+                    patches.append((list_item, payload))
+                used_list_ids.append(list_item["id"])
             else:
-                info(f"Marking list {list_item['name']} for deletion")
-                excess_list_ids.append(list_item["id"])
+                excess_lists.append(list_item)
 
-        for index in missing_indices:
-            if index - 1 < len(chunked_lists):
-                formatted_counter = f"{index:03d}"
-                info(f"Creating list {self.adlist_name} - {formatted_counter}")
+        creates = []
+        for index in sorted(set(chunked_lists) - set(existing_lists)):
+            payload = utils.create_list_payload(
+                f"{self.adlist_name} - {index:03d}", chunked_lists[index]
+            )
+            creates.append((index, payload))
 
-                payload = utils.create_list_payload(
-                    f"{self.adlist_name} - {formatted_counter}", chunked_lists[index - 1]
-                )
+        policy = remote_state["policy"]
+        return {
+            "existing_lists": existing_lists,
+            "chunked_lists": chunked_lists,
+            "used_list_ids": used_list_ids,
+            "patches": patches,
+            "creates": creates,
+            "excess_lists": excess_lists,
+            "policy_id": policy["id"] if policy else None,
+            "policy_traffic": policy.get("traffic") if policy else None,
+        }
 
-                created_list = cloudflare.create_list(payload)
-                if created_list:
-                    used_list_ids.append(created_list["id"])
+    def show_plan(self, plan):
+        for list_item, payload in plan["patches"]:
+            info(f"Would update list {list_item['name']}: +{len(payload['append'])} -{len(payload['remove'])}")
+        for index, payload in plan["creates"]:
+            info(f"Would create list {payload['name']} with {len(payload['items'])} domains")
+        for list_item in plan["excess_lists"]:
+            info(f"Would delete list {list_item['name']}")
 
-        policy_id = None
-        for policy_item in current_policies:
-            if policy_item["name"] == self.policy_name:
-                policy_id = policy_item["id"]
+        # Lists that do not exist yet are shown by name in the expression
+        traffic = utils.create_policy_json(
+            self.policy_name,
+            plan["used_list_ids"] + [payload["name"] for index, payload in plan["creates"]],
+        )["traffic"]
+        if not plan["policy_id"] or plan["policy_id"] == "null":
+            info(f"Would create policy {self.policy_name}")
+        elif plan["creates"] or traffic != plan["policy_traffic"]:
+            info(f"Would update policy {self.policy_name}")
+        else:
+            info(f"No changes for policy {self.policy_name}")
 
+        items_appended, items_removed = utils.count_plan_items(plan)
+        info(
+            f"Plan: {len(plan['creates'])} creates, {len(plan['patches'])} patches, "
+            f"{len(plan['excess_lists'])} deletes, {items_appended + items_removed} items moved"
+        )
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def patch_list(self, list_item, payload, domains):
+        if self.out_of_time():
+            return None
+        cloudflare.patch_list(list_item["id"], payload)
+        self.manifest.log_update(list_item["id"], list_item["name"], domains)
+        return list_item
+
+    def create_list(self, payload, domains):
+        if self.out_of_time():
+            return None
+        created_list = cloudflare.create_list(payload)
+        self.manifest.log_update(created_list["id"], payload["name"], domains)
+        return created_list
+
+    def delete_list(self, list_item):
+        cloudflare.delete_list(list_item["id"])
+        self.manifest.log_remove(list_item["id"])
+        return list_item
+
+    @metrics.timed("manager.apply")
+    def apply(self, plan):
+        existing_lists = plan["existing_lists"]
+        chunked_lists = plan["chunked_lists"]
+        used_list_ids = list(plan["used_list_ids"])
+        patches = plan["patches"]
+        creates = plan["creates"]
+
+        # Forget lists before mutating them so an interrupted run never
+        # leaves the manifest trusting stale contents. Lists that need no
+        # patch are trusted as they are.
+        self.manifest.retain({
+            list_item["id"]: chunked_lists.get(list_index, [])
+            for list_index, list_item in existing_lists.items()
+        })
+        patched_ids = {list_item["id"] for list_item, payload in patches}
+        for list_index, list_item in existing_lists.items():
+            if list_index in chunked_lists and list_item["id"] not in patched_ids:
+                self.manifest.update(list_item["id"], list_item["name"], chunked_lists[list_index])
+        self.manifest.save()
+        self.manifest.log_plan(len(patches) + len(creates) + len(plan["excess_lists"]) + 1)
+
+        for list_item, payload in patches:
+            info(
+                f"Updating list {list_item['name']}: "
+                f"+{len(payload['append'])} -{len(payload['remove'])}"
+            )
+        for index, payload in creates:
+            info(f"Creating list {payload['name']}")
+
+        # Patches and creates touch distinct lists, so they can run side by
+        # side. Results come back in submission order, which keeps
+        # used_list_ids and the policy expression deterministic. Each one is
+        # journaled as soon as it completes.
+        index_by_id = {list_item["id"]: list_index for list_index, list_item in existing_lists.items()}
+        results = cloudflare.execute(
+            [
+                (self.patch_list, list_item, payload, chunked_lists[index_by_id[list_item["id"]]])
+                for list_item, payload in patches
+            ]
+            + [(self.create_list, payload, chunked_lists[index]) for index, payload in creates]
+        )
+
+        for created_list in results[len(patches):]:
+            if created_list:
+                used_list_ids.append(created_list["id"])
+
+        skipped = results.count(None)
+        metrics.set("skipped_operations", skipped)
+        if skipped:
+            # Every list the policy references still exists and the lists
+            # created so far are journaled, so this is a consistent point to
+            # stop at. The next run plans only the remaining changes.
+            silent_error(
+                f"Time budget exhausted, stopping with {skipped} list operations, "
+                f"the policy update and {len(plan['excess_lists'])} deletions left for the next run"
+            )
+            self.manifest.save()
+            return False
+
+        items_appended, items_removed = utils.count_plan_items(plan)
+        info(f"Items moved: {items_appended + items_removed} ({items_appended} appended, {items_removed} removed)")
+
+        policy_id = plan["policy_id"]
         json_data = utils.create_policy_json(
             self.policy_name, used_list_ids
         )
@@ -115,20 +309,65 @@ class CloudflareManager:
         if not policy_id or policy_id == "null":
             info(f"Creating policy {self.policy_name}")
             cloudflare.create_policy(json_data)
+        elif plan["policy_traffic"] == json_data["traffic"]:
+            info(f"No changes detected for policy {self.policy_name}, skipping update")
         else:
             info(f"Updating policy {self.policy_name}")
             cloudflare.update_policy(policy_id, json_data)
 
-        if excess_list_ids:
-            for list_item in current_lists:
-                if list_item["id"] in excess_list_ids:
-                    info(f"Deleting list {list_item['name']}")
-                    cloudflare.delete_list(list_item["id"])
+        # Lists are only deleted once the policy no longer references them
+        for list_item in plan["excess_lists"]:
+            info(f"Deleting list {list_item['name']}")
+        cloudflare.execute([(self.delete_list, list_item) for list_item in plan["excess_lists"]])
+
+        self.manifest.save()
+        return True
+
+    def build_plan(self, use_cache=True, verify=False):
+        # Downloading and parsing the sources and reading the current state
+        # from Cloudflare are independent, so they run side by side and the
+        # plan is made as soon as both are done. The read runs in a copy of
+        # this context so it uses the same client.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            remote_state = executor.submit(contextvars.copy_context().run, self.fetch_remote_state, verify)
+            domain_list = self.build_domain_list(use_cache)
+            return self.plan(domain_list, remote_state.result())
+
+    def run(self, use_cache=True, verify=False):
+        with requests.use_client(self.client):
+            plan = self.build_plan(use_cache, verify)
+            if plan:
+                self.apply(plan)
+
+    def sync(self, use_cache=True, verify=False):
+        # One serve cycle. The converter and its domain index stay in memory.
+        self.push(self.build_domain_list(use_cache), verify)
+
+    def push(self, domain_list, verify=False):
+        # Cloudflare is only read and written when the domain list differs
+        # from the one last pushed in full
+        if domain_list == self.synced_list:
+            info(f"No domain list changes for {self.policy_name} since the last sync, nothing to push")
+            return
+        with requests.use_client(self.client):
+            plan = self.plan(domain_list, self.fetch_remote_state(verify))
+            if plan and self.apply(plan):
+                self.synced_list = domain_list
+
+    def dry_run(self, use_cache=True, verify=False):
+        with requests.use_client(self.client):
+            plan = self.build_plan(use_cache, verify)
+            if plan:
+                self.show_plan(plan)
 
     def leave(self):
+        with requests.use_client(self.client):
+            self.remove_all()
+
+    def remove_all(self):
         current_lists = cloudflare.get_current_lists()
         current_policies = cloudflare.get_current_policies()
-        current_lists.sort(key=utils.safe_sort_key)
+        current_lists.sort(key=lambda list_item: utils.safe_sort_key(list_item, self.adlist_name))
         policy_id = None
         list_ids_to_delete = []
 
@@ -139,7 +378,7 @@ class CloudflareManager:
                 cloudflare.delete_policy(policy_id)
 
         for list_item in current_lists:
-            if f"{self.adlist_name}" in list_item["name"]:
+            if utils.list_index(self.adlist_name, list_item["name"]) is not None:
                 list_ids_to_delete.append(list_item['id'])
 
         for list_id in list_ids_to_delete:
@@ -147,19 +386,193 @@ class CloudflareManager:
                 list_item for list_item in current_lists if list_item["id"] == list_id
             )
             info(f"Deleting list {list_to_delete['name']}")
-            cloudflare.delete_list(list_id)
+        cloudflare.execute([(cloudflare.delete_list, list_id) for list_id in list_ids_to_delete])
+
+class Fleet(Syncer):
+    # Several targets (accounts and policy prefixes) kept in sync with one
+    # domain list. The sources are downloaded and parsed once, then every
+    # target syncs concurrently through its own client, rate limiter and
+    # manifest.
+    def __init__(self, targets, max_list_size):
+        super().__init__()
+        self.managers = {
+            target.name: CloudflareManager(target.prefix, target.max_lists, max_list_size, target.client)
+            for target in targets
+        }
+
+    def each(self, func):
+        # Calls func(manager) for every target side by side, each inside its
+        # own client's context. A failing target does not stop the others.
+        def call(name, manager):
+            start = time.monotonic()
+            try:
+                with requests.use_client(manager.client):
+                    manager.deadline = self.deadline
+                    func(manager)
+                status = "ok"
+            except (Exception, SystemExit) as e:
+                silent_error(f"Target {name} failed: {e}")
+                status = "failed"
+            info(f"Target {name} finished ({status}) in {time.monotonic() - start:.1f}s")
+            return {
+                "status": status,
+                "seconds": time.monotonic() - start,
+                "rate": manager.client.rate_limiter.rate,
+                "wait_seconds": manager.client.rate_limiter.total_wait,
+                "breaker_trips": manager.client.breaker.trips,
+            }
+
+        with ThreadPoolExecutor(max_workers=len(self.managers)) as executor:
+            results = dict(zip(self.managers, executor.map(call, self.managers, self.managers.values())))
+        metrics.set("targets", results)
+        return results
+
+    def check(self, results):
+        failed = [name for name, result in results.items() if result["status"] != "ok"]
+        if failed:
+            error(f"{len(failed)} of {len(results)} targets failed: {', '.join(failed)}")
+
+    def sync_targets(self, use_cache, verify, handle_plan):
+        # As in CloudflareManager.build_plan, every target reads its state
+        # from Cloudflare while the sources are downloaded and parsed
+        domain_list = Future()
+
+        def sync_target(manager):
+            remote_state = manager.fetch_remote_state(verify)
+            plan = manager.plan(domain_list.result(), remote_state)
+            if plan:
+                handle_plan(manager, plan)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            results = executor.submit(self.each, sync_target)
+            try:
+                domain_list.set_result(self.build_domain_list(use_cache))
+            except BaseException as e:
+                domain_list.set_exception(e)
+                raise
+            return results.result()
+
+    def run(self, use_cache=True, verify=False):
+        self.check(self.sync_targets(use_cache, verify, lambda manager, plan: manager.apply(plan)))
+
+    def dry_run(self, use_cache=True, verify=False):
+        self.check(self.sync_targets(use_cache, verify, lambda manager, plan: manager.show_plan(plan)))
+
+    def sync(self, use_cache=True, verify=False):
+        domain_list = self.build_domain_list(use_cache)
+        self.each(lambda manager: manager.push(domain_list, verify))
+
+    def leave(self):
+        self.check(self.each(lambda manager: manager.leave()))
 
 def main():
+    start = time.monotonic()
     parser = argparse.ArgumentParser(description="Cloudflare Manager Script")
-    parser.add_argument("action", choices=["run", "leave"], help="Choose action: run or leave")
+    parser.add_argument("action", choices=["run", "plan", "leave", "serve"], help="Choose action: run, plan, leave or serve")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the on-disk download cache")
+    parser.add_argument("--verify", action="store_true", help="Read every list from Cloudflare instead of trusting the local manifest")
+    parser.add_argument("--mock", action="store_true", help="Talk to an in-process mock Gateway API instead of Cloudflare")
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="Seconds of latency added to every mock API call")
+    parser.add_argument("--mock-throttle", type=float, default=0.0, help="Fraction of mock API calls answered with 429")
+    parser.add_argument("--mock-outage", type=float, default=0.0, help="Fraction of mock API calls answered with 503")
+    parser.add_argument("--metrics", default=os.path.join(CACHE_DIR, "metrics.json"), help="Write the JSON metrics report here ('-' for stdout)")
+    parser.add_argument("--profile", choices=["cpu", "memory"], help="Capture a cProfile (of every thread) or tracemalloc profile of the run")
+    parser.add_argument("--time-budget", type=float, default=SYNC_TIME_BUDGET, help="Stop starting list changes after this many seconds (0 for no limit)")
+    parser.add_argument("--interval", type=float, default=SERVE_INTERVAL, help="Seconds between syncs when serving")
+    parser.add_argument("--targets", default=CF_TARGETS, help="Sync every account listed in this config file instead of CF_IDENTIFIER")
     args = parser.parse_args()    
-    cloudflare_manager = CloudflareManager(PREFIX, MAX_LISTS, MAX_LIST_SIZE)
-    if args.action == "run":
-        cloudflare_manager.run()
-    elif args.action == "leave":
-        cloudflare_manager.leave()
+
+    if args.targets:
+        targets = load_targets(args.targets)
+        if args.mock:
+            # One mock Gateway per target, like separate accounts
+            for target in targets:
+                gateway = mock.MockGateway(latency=args.mock_latency, throttle=args.mock_throttle, outage=args.mock_outage).start()
+                target.client = requests.CloudflareClient(
+                    target.client.account_id, "mock", gateway.url, limiter=target.client.rate_limiter
+                )
+                info(f"Using mock Gateway API at {gateway.url} for target {target.name}")
+        cloudflare_manager = Fleet(targets, MAX_LIST_SIZE)
     else:
-        error("Invalid action. Please choose either 'python -m src run' or 'python -m src leave'.")
+        if args.mock:
+            gateway = mock.MockGateway(latency=args.mock_latency, throttle=args.mock_throttle, outage=args.mock_outage).start()
+            requests.client = requests.CloudflareClient("mock", "mock", gateway.url)
+            info(f"Using mock Gateway API at {gateway.url}")
+        elif not CF_API_TOKEN or not CF_IDENTIFIER:
+            error("Missing Cloudflare credentials")
+        cloudflare_manager = CloudflareManager(PREFIX, MAX_LISTS, MAX_LIST_SIZE)
+
+    if args.time_budget and args.action != "serve":
+        cloudflare_manager.deadline = start + args.time_budget
+        requests.retry_budget.reset(cloudflare_manager.deadline)
+    profiler = ThreadProfiler() if args.profile == "cpu" else None
+    if profiler:
+        profiler.enable()
+    elif args.profile == "memory":
+        tracemalloc.start()
+
+    try:
+        if args.action == "run":
+            cloudflare_manager.run(use_cache=not args.no_cache, verify=args.verify)
+        elif args.action == "plan":
+            cloudflare_manager.dry_run(use_cache=not args.no_cache, verify=args.verify)
+        elif args.action == "leave":
+            cloudflare_manager.leave()
+        elif args.action == "serve":
+            signal.signal(signal.SIGTERM, lambda signum, frame: cloudflare_manager.stopping.set())
+            try:
+                cloudflare_manager.serve(
+                    args.interval, use_cache=not args.no_cache, verify=args.verify, time_budget=args.time_budget
+                )
+            except KeyboardInterrupt:
+                info("Interrupted, stopped serving")
+        else:
+            error("Invalid action. Please choose either 'python -m src run', 'python -m src plan', 'python -m src leave' or 'python -m src serve'.")
+    except requests.HTTPException as e:
+        error(f"Giving up on the Cloudflare API: {e}")
+    except domains.SourceUnavailable as e:
+        error(f"Not syncing without every source: {e}")
+    finally:
+        write_report(args, profiler)
+
+def write_report(args, profiler):
+    metrics.set("action", args.action)
+    # With targets every client is a target's own, and its rate limit and
+    # breaker trips are reported per target under "targets"
+    if not args.targets:
+        metrics.set("rate_limit", {
+            "rate": requests.client.rate_limiter.rate,
+            "wait_seconds": requests.client.rate_limiter.total_wait,
+        })
+        metrics.set("circuit_breaker", {"trips": requests.client.breaker.trips})
+    metrics.set("retry_budget", {"retries": requests.retry_budget.retries, "remaining": requests.retry_budget.remaining})
+
+    if profiler:
+        profiler.disable()
+        stats = profiler.stats()
+        profile_path = os.path.join(CACHE_DIR, "profile.pstats")
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        stats.dump_stats(profile_path)
+        metrics.set("profile", profile_path)
+        stats.sort_stats("cumulative").print_stats(20)
+    elif tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        metrics.set("memory", {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [str(stat) for stat in snapshot.statistics("lineno")[:20]],
+        })
+
+    if args.metrics != "-":
+        os.makedirs(os.path.dirname(args.metrics) or ".", exist_ok=True)
+    metrics.write(args.metrics)
+    report = metrics.report()
+    info(
+        f"Run took {report['wall_seconds']:.1f}s with {report['requests']['count']} API requests, "
+        f"{report['retries']['count']} retries, {report['retries']['sleep_seconds']:.1f}s sleeping"
+    )
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,190 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+from src import info, silent_error
+
+class DownloadCache:
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f"{base}.body", f"{base}.json"
+
+    def get(self, url):
+        body_path, meta_path = self.paths(url)
+        if not os.path.exists(body_path):
+            return None
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def validators(self, url):
+        meta = self.get(url)
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def touch(self, url):
+        # Bump mtime so eviction drops the least recently used entries first
+        os.utime(self.paths(url)[1])
+
+    def digest(self, url):
+        meta = self.get(url)
+        if meta is None:
+            return None
+        if not meta.get("sha256"):
+            # Entries cached before bodies were hashed, hash them once now
+            body_path, meta_path = self.paths(url)
+            with open(body_path, "rb") as f:
+                meta["sha256"] = hashlib.file_digest(f, "sha256").hexdigest()
+            with open(f"{meta_path}.tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(f"{meta_path}.tmp", meta_path)
+        return meta["sha256"]
+
+    def read_chunks(self, url, chunk_size=65536):
+        body_path, meta_path = self.paths(url)
+        with open(body_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def store_chunks(self, url, chunks, etag=None, last_modified=None):
+        body_path, meta_path = self.paths(url)
+        tmp_path = f"{body_path}.{threading.get_ident()}.tmp"
+        size = 0
+        body_hash = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    body_hash.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            meta = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": size,
+                "sha256": body_hash.hexdigest(),
+            }
+            try:
+                with open(f"{meta_path}.tmp", "w") as f:
+                    json.dump(meta, f)
+                os.replace(tmp_path, body_path)
+                os.replace(f"{meta_path}.tmp", meta_path)
+            except OSError as e:
+                silent_error(f"Failed to cache {url}: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.directory, name)
+            body_path = meta_path[:-len(".json")] + ".body"
+            try:
+                size = os.path.getsize(body_path)
+                used = os.path.getmtime(meta_path)
+            except OSError:
+                continue
+            entries.append((used, size, body_path, meta_path))
+            total_size += size
+
+        entries.sort()
+        evicted = 0
+        for used, size, body_path, meta_path in entries:
+            if total_size <= self.max_size:
+                break
+            for path in (body_path, meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_size -= size
+            evicted += 1
+
+        if evicted:
+            info(f"Evicted {evicted} entries from download cache")
+
+class ParsedCache:
+    # Extracted domain sets keyed by the SHA-256 of the raw body they were
+    # parsed from. File names carry the parser fingerprint, so entries written
+    # under different parsing rules are never loaded and get evicted first.
+    def __init__(self, directory, max_size, fingerprint):
+        self.directory = directory
+        self.max_size = max_size
+        self.fingerprint = fingerprint
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{self.fingerprint}-{digest}.gz")
+
+    def load(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as f:
+                text = gzip.decompress(f.read()).decode("utf-8")
+            os.utime(path)
+        except (OSError, EOFError, UnicodeDecodeError):
+            return None
+        return set(text.split("\n")) if text else set()
+
+    def store(self, digest, domains):
+        path = self.path(digest)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(gzip.compress("\n".join(sorted(domains)).encode("utf-8"), compresslevel=1))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            silent_error(f"Failed to cache parsed domains {digest}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        evicted = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if not name.startswith(f"{self.fingerprint}-"):
+                    os.remove(path)
+                    evicted += 1
+                    continue
+                size = os.path.getsize(path)
+                used = os.path.getmtime(path)
+            except OSError:
+                continue
+            entries.append((used, size, path))
+            total_size += size
+
+        entries.sort()
+        for used, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+            evicted += 1
+
+        if evicted:
+            info(f"Evicted {evicted} entries from parsed cache")
@@ -1,53 +1,95 @@
 import json
-from src.requests import rate_limited_request, cloudflare_gateway_request, retry_config, retry
+import contextvars
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from src import MAX_LIST_SIZE, CLOUDFLARE_WORKERS
+from src.metrics import metrics
+from src.requests import cloudflare_gateway_request, retry_config, retry
 
+@metrics.timed("cloudflare.get_current_lists")
 @retry(**retry_config)
 def get_current_lists():
     status, response = cloudflare_gateway_request("GET", "/lists")
     return response["result"] or []
 
+@metrics.timed("cloudflare.get_current_policies")
 @retry(**retry_config)
 def get_current_policies():
     status, response = cloudflare_gateway_request("GET", "/rules")
     return response["result"] or []
 
+@metrics.timed("cloudflare.get_list_items_page")
 @retry(**retry_config)
+def get_list_items_page(list_id, cursor=None):
+    endpoint = f"/lists/{list_id}/items?limit={MAX_LIST_SIZE}"
+    if cursor:
+        endpoint += f"&cursor={urllib.parse.quote(cursor)}"
+    status, response = cloudflare_gateway_request("GET", endpoint)
+    return response["result"] or [], response.get("result_info") or {}
+
+def iter_list_items(list_id):
+    cursor = None
+    while True:
+        items, result_info = get_list_items_page(list_id, cursor)
+        yield from items
+        cursor = (result_info.get("cursors") or {}).get("after")
+        if not items or not cursor:
+            break
+
+@metrics.timed("cloudflare.get_list_items")
 def get_list_items(list_id):
-    status, response = cloudflare_gateway_request("GET", f"/lists/{list_id}/items?limit=1000")
-    return response["result"]
+    return list(iter_list_items(list_id))
+
+@metrics.timed("cloudflare.get_lists_items")
+def get_lists_items(list_ids, max_workers=CLOUDFLARE_WORKERS):
+    return dict(zip(list_ids, execute([(get_list_items, list_id) for list_id in list_ids], max_workers)))
+
+def execute(operations, max_workers=CLOUDFLARE_WORKERS):
+    # Run independent (func, *args) calls concurrently, every call still
+    # passing through the shared rate limiter, and return results in order.
+    # Each call runs in a copy of the caller's context, so it talks to the
+    # same client (see requests.use_client).
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func, *args) for func, *args in operations
+        ]
+        return [future.result() for future in futures]
 
+@metrics.timed("cloudflare.patch_list")
 @retry(**retry_config)
-@rate_limited_request
 def patch_list(list_id, payload):
     body = json.dumps(payload)
     status, response = cloudflare_gateway_request("PATCH", f"/lists/{list_id}", body)
     return response["result"]
 
+@metrics.timed("cloudflare.create_list")
 @retry(**retry_config)
-@rate_limited_request
 def create_list(payload):
     body = json.dumps(payload)
     status, response = cloudflare_gateway_request("POST", "/lists", body)
     return response ["result"]
 
+@metrics.timed("cloudflare.create_policy")
 @retry(**retry_config)
 def create_policy(json_data):
     body = json.dumps(json_data)
     status, response = cloudflare_gateway_request("POST", "/rules", body)
     return response["result"]
 
+@metrics.timed("cloudflare.update_policy")
 @retry(**retry_config)
 def update_policy(policy_id, json_data):
     body = json.dumps(json_data)
     status, response = cloudflare_gateway_request("PUT", f"/rules/{policy_id}", body)
     return response["result"]
 
+@metrics.timed("cloudflare.delete_list")
 @retry(**retry_config)
-@rate_limited_request
 def delete_list(list_id):
     status, response = cloudflare_gateway_request("DELETE", f"/lists/{list_id}")
     return response["result"]
 
+@metrics.timed("cloudflare.delete_policy")
 @retry(**retry_config)
 def delete_policy(policy_id):
     status, response = cloudflare_gateway_request("DELETE", f"/rules/{policy_id}")
@@ -1,32 +1,57 @@
+import hashlib
+import inspect
+from typing import Iterable
+from itertools import islice
+from collections import deque
+from src.metrics import metrics
+from src.domainset import DomainSet
 from src import (
     info,
+    WHITELIST_SUBDOMAINS,
+    PARSE_BATCH_SIZE,
     ip_pattern, 
     domain_pattern, 
     replace_pattern
 )
 
-def convert_to_domain_list(block_content: str, white_content: str) -> list[str]:
-    white_domains = set()
-    block_domains = set()
+HOSTS_PREFIXES = ("0.0.0.0 ", "127.0.0.1 ")
 
-    extract_domains(white_content, white_domains)
+@metrics.timed("convert.convert_to_domain_list")
+def convert_to_domain_list(block_domains: set[str], white_domains: set[str]) -> DomainSet:
     info(f"Number of whitelisted domains: {len(white_domains)}")
-
-    extract_domains(block_content, block_domains)
-    block_domains = remove_subdomains_if_higher(block_domains)
     info(f"Number of blocked domains: {len(block_domains)}")
 
-    final_domains = sorted(list(block_domains - white_domains))
+    final_domains = collapse_domain_keys(
+        domain_keys(block_domains), {domain_to_key(domain) for domain in white_domains}
+    )
     info(f"Number of final domains: {len(final_domains)}")
 
     return final_domains
 
-def extract_domains(content: str, domains: set[str]) -> None:
-    for line in content.splitlines():
+def collapse_domain_keys(block_keys: list[str], white_keys: set[str]) -> DomainSet:
+    # block_keys must be sorted. The result keeps the index order, which
+    # groups each domain with its subdomains' siblings.
+    if WHITELIST_SUBDOMAINS:
+        # Appending a sorted run keeps the sort a single merge
+        keys = block_keys + sorted(white_keys)
+        keys.sort()
+        final_keys = collapse_subdomains(keys, white_keys)
+    else:
+        final_keys = [key for key in collapse_subdomains(block_keys) if key not in white_keys]
+    return DomainSet.from_keys(final_keys)
+
+def extract_domains(lines: Iterable[str], domains: set[str]) -> None:
+    for line in lines:
         if line.startswith(("#", "!", "/")) or line == "":
             continue
 
         cleaned_line = line.lower().strip().split("#")[0].split("^")[0].replace("\r", "")
+        domain = match_plain_domain(cleaned_line)
+        if domain is not None:
+            if domain:
+                domains.add(domain)
+            continue
+
         domain = replace_pattern.sub("", cleaned_line, count=1)
         try:
             domain = domain.encode("idna").decode("utf-8", "replace")
@@ -35,20 +60,96 @@ def extract_domains(content: str, domains: set[str]) -> None:
         except Exception:
             pass
             
+def match_plain_domain(cleaned_line: str) -> str | None:
+    # Fast path for the common "0.0.0.0 host", "||host^" and "host" shapes.
+    # Returns the domain, "" when the line is certainly invalid, or None when
+    # only the regex/IDNA path can decide.
+    if cleaned_line.startswith("||"):
+        domain = cleaned_line[2:]
+    elif cleaned_line.startswith(HOSTS_PREFIXES):
+        domain = cleaned_line.partition(" ")[2].lstrip()
+    else:
+        domain = cleaned_line
+
+    # Only plain ASCII letters, digits, dots and hyphens are handled here,
+    # anything else (IDN, whitespace, wildcards) takes the slow path
+    if not (domain.isascii() and domain.replace(".", "").replace("-", "").isalnum()):
+        return None
+
+    if (
+        domain[0] in ".-" or domain[-1] in ".-"
+        or ".." in domain or ".-" in domain or "-." in domain
+    ):
+        return ""
+    if len(domain) > 63 and max(map(len, domain.split("."))) > 63:
+        return ""
+    if domain.count(".") == 3 and domain.replace(".", "").isdigit():
+        if all(len(label) <= 3 for label in domain.split(".")):
+            return ""
+    return domain
+
+def parser_fingerprint() -> str:
+    # Changes whenever the patterns or the line parser itself change, so
+    # cached parse results are never reused across different parsing rules
+    rules = [pattern.pattern for pattern in (replace_pattern, domain_pattern, ip_pattern)]
+    rules += HOSTS_PREFIXES
+    rules += [inspect.getsource(func) for func in (extract_domains, match_plain_domain)]
+    return hashlib.sha256("\0".join(rules).encode("utf-8")).hexdigest()[:16]
+
+def extract_batch(content: str) -> str:
+    domains = set()
+    extract_domains(content.split("\n"), domains)
+    # A single string pickles far faster than a set of small strings
+    return "\n".join(domains)
+
+def extract_domains_parallel(
+    lines: Iterable[str], domains: set[str], executor,
+    batch_size: int = PARSE_BATCH_SIZE, max_pending: int = 8,
+) -> None:
+    # Shard lines across a process pool, keeping at most max_pending batches
+    # in flight so memory stays bounded on huge sources
+    pending = deque()
+    lines = iter(lines)
+    while batch := list(islice(lines, batch_size)):
+        pending.append(executor.submit(extract_batch, "\n".join(batch)))
+        if len(pending) >= max_pending:
+            merge_batch(pending.popleft().result(), domains)
+    while pending:
+        merge_batch(pending.popleft().result(), domains)
+
+def merge_batch(result: str, domains: set[str]) -> None:
+    if result:
+        domains.update(result.split("\n"))
+
+def domain_to_key(domain: str) -> str:
+    # "ads.example.com" -> "moc.elpmaxe.sda." so that a domain's key is a
+    # prefix of the keys of all of its subdomains
+    return ("." + domain)[::-1]
+
+def key_to_domain(key: str) -> str:
+    return key[-2::-1]
+
+def domain_keys(domains: Iterable[str], extra_keys: Iterable[str] = ()) -> list[str]:
+    keys = [("." + domain)[::-1] for domain in domains]
+    keys.extend(extra_keys)
+    keys.sort()
+    return keys
+
+def collapse_subdomains(keys: list[str], white_keys: set[str] = frozenset()) -> list[str]:
+    # In sorted order every subdomain directly follows its closest listed
+    # parent, so comparing against the last kept key is enough. Whitelisted
+    # keys are merged into the same order and cover their subdomains, but
+    # are not kept themselves.
+    top_level_keys = []
+    append = top_level_keys.append
+    parent = "\0"
+    for key in keys:
+        if key.startswith(parent):
+            continue
+        parent = key
+        if key not in white_keys:
+            append(key)
+    return top_level_keys
+
 def remove_subdomains_if_higher(domains: set[str]) -> set[str]:
-    top_level_domains = set()
-    
-    for domain in domains:
-        parts = domain.split(".")
-            
-        is_lower_subdomain = False            
-        for i in range(1, len(parts)):
-            higher_domain = ".".join(parts[i:])
-            if higher_domain in domains:
-                is_lower_subdomain = True
-                break
-                    
-        if not is_lower_subdomain:
-            top_level_domains.add(domain)
-                
-    return top_level_domains
+    return {key[-2::-1] for key in collapse_subdomains(domain_keys(domains))}
@@ -1,17 +1,53 @@
 import os
+import time
+import codecs
+import hashlib
 import http.client
-from urllib.parse import urlparse
+from urllib.parse import urlsplit
 from configparser import ConfigParser
-from src import info, convert, silent_error
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from src.cache import DownloadCache, ParsedCache
+from src.metrics import metrics
+from src.fetch import ConnectionPool, open_url, iter_body
+from src.incremental import DomainIndex
+from src import (
+    info, convert, silent_error,
+    DOWNLOAD_WORKERS, DOWNLOAD_TIMEOUT, CACHE_DIR, DOWNLOAD_CACHE_SIZE, PARSED_CACHE_SIZE,
+    PARSE_WORKERS,
+)
+
+LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+class SourceUnavailable(Exception):
+    # A source failed and there is no earlier copy of it to sync from
+    pass
 
 class DomainConverter:
-    def __init__(self):
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, timeout=DOWNLOAD_TIMEOUT, use_cache=True, parse_workers=PARSE_WORKERS):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.parse_workers = parse_workers
+        self.parse_executor = None
+        # Sources on the same host reuse one another's connections
+        self.pool = ConnectionPool(max_workers)
+        self.cache = (
+            DownloadCache(os.path.join(CACHE_DIR, "downloads"), DOWNLOAD_CACHE_SIZE)
+            if use_cache else None
+        )
+        self.parsed_cache = (
+            ParsedCache(os.path.join(CACHE_DIR, "parsed"), PARSED_CACHE_SIZE, convert.parser_fingerprint())
+            if use_cache else None
+        )
         self.env_file_map = {
             "ADLIST_URLS": "./lists/adlist.ini",
             "WHITELIST_URLS": "./lists/whitelist.ini",
             "DYNAMIC_BLACKLIST": "./lists/dynamic_blacklist.txt",
             "DYNAMIC_WHITELIST": "./lists/dynamic_whitelist.txt"
         }
+        self.index = None
+        self.reload_urls()
+
+    def reload_urls(self):
         self.adlist_urls = self.read_urls("ADLIST_URLS")
         self.whitelist_urls = self.read_urls("WHITELIST_URLS")
 
@@ -43,44 +79,195 @@ class DomainConverter:
         urls += self.read_urls_from_env(env_var)
         return urls
 
-    def download_file(self, url):
-        parsed_url = urlparse(url)
-        if parsed_url.scheme == "https":
-            conn = http.client.HTTPSConnection(parsed_url.netloc)
+    def read_response(self, response, deadline):
+        for chunk in iter_body(response):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"exceeded {self.timeout}s")
+            yield chunk
+
+    def open_source(self, url):
+        # Returns the body's SHA-256 when it is already known (a 304 answered
+        # from the download cache) along with an iterator over its chunks
+        start = time.monotonic()
+        deadline = start + self.timeout
+        headers = self.cache.validators(url) if self.cache else {}
+        final_url, conn, response = open_url(self.pool, url, headers, self.timeout)
+        parts = urlsplit(final_url)
+        try:
+            if response.status == 304 and self.cache:
+                response.read()
+                self.pool.finish(parts.scheme, parts.netloc, conn, response)
+                info(f"Not modified, using cached file from {url}")
+                self.cache.touch(url)
+                metrics.record_download(url, time.monotonic() - start, 0, True)
+                return self.cache.digest(url), self.cache.read_chunks(url)
+            if response.status != 200:
+                raise http.client.HTTPException(f"status code: {response.status}")
+        except Exception:
+            conn.close()
+            raise
+        return None, self.fetch_chunks(url, parts, conn, response, start, deadline)
+
+    def fetch_chunks(self, url, parts, conn, response, start, deadline):
+        try:
+            chunks = self.read_response(response, deadline)
+            if self.cache:
+                chunks = self.cache.store_chunks(
+                    url, chunks, response.getheader("ETag"), response.getheader("Last-Modified")
+                )
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            info(f"Downloaded file from {url} File size: {size}")
+            metrics.record_download(url, time.monotonic() - start, size, False)
+        finally:
+            # Only a fully read response leaves its connection reusable
+            self.pool.finish(parts.scheme, parts.netloc, conn, response)
+
+    def extract_source(self, url, known_digest=None):
+        # Returns the body's digest with its domains, which are None when the
+        # body is still the one the domain index was built from
+        try:
+            digest, chunks = self.open_source(url)
+            return self.parse_source(url, digest, chunks, known_digest)
+        except Exception as e:
+            # Dropping the source would remove its domains from Cloudflare,
+            # so the last body that was downloaded stands in for it
+            if not self.cache or self.cache.get(url) is None:
+                raise SourceUnavailable(f"{url}: {e}") from e
+            silent_error(f"Failed to download file from {url}, using the cached copy: {e}")
+            return self.parse_source(url, self.cache.digest(url), self.cache.read_chunks(url), known_digest)
+
+    def parse_source(self, url, digest, chunks, known_digest):
+        if digest and digest == known_digest:
+            chunks.close()
+            return digest, None
+        if digest and self.parsed_cache:
+            cached_domains = self.parsed_cache.load(digest)
+            if cached_domains is not None:
+                info(f"Using {len(cached_domains)} parsed domains cached for {url}")
+                return digest, cached_domains
+
+        body_hash = hashlib.sha256()
+        if not digest and self.parsed_cache:
+            chunks = hash_chunks(chunks, body_hash)
+
+        domains = set()
+        if self.parse_executor:
+            convert.extract_domains_parallel(
+                iter_lines(chunks), domains, self.parse_executor, max_pending=2 * self.parse_workers
+            )
         else:
-            conn = http.client.HTTPConnection(parsed_url.netloc)
-        conn.request("GET", parsed_url.path)
-        response = conn.getresponse()
-        if response.status != 200:
-            silent_error(f"Failed to download file from {url}, status code: {response.status}")
-        data = response.read().decode('utf-8')
-        conn.close()
-        info(f"Downloaded file from {url} File size: {len(data)}")
-        return data
-        
-    def process_urls(self):
-        block_content = ""
-        white_content = ""
-        for url in self.adlist_urls:
-            block_content += self.download_file(url)
-        for url in self.whitelist_urls:
-            white_content += self.download_file(url)
-        
+            convert.extract_domains(iter_lines(chunks), domains)
+
+        if self.parsed_cache:
+            digest = digest or body_hash.hexdigest()
+            self.parsed_cache.store(digest, domains)
+        return digest, domains
+
+    def extract_text(self, text, known_digest=None):
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if digest == known_digest:
+            return digest, None
+        domains = self.parsed_cache.load(digest) if self.parsed_cache else None
+        if domains is None:
+            domains = set()
+            convert.extract_domains(text.splitlines(), domains)
+            if self.parsed_cache:
+                self.parsed_cache.store(digest, domains)
+        return digest, domains
+
+    def read_dynamic_list(self, env_var):
         # Check for dynamic blacklist and whitelist in environment variables
-        dynamic_blacklist = os.getenv("DYNAMIC_BLACKLIST", "")
-        dynamic_whitelist = os.getenv("DYNAMIC_WHITELIST", "")
-        
-        if dynamic_blacklist:
-            block_content += dynamic_blacklist
-        else:
-            with open(self.env_file_map["DYNAMIC_BLACKLIST"], "r") as black_file:
-                block_content += black_file.read()
-        
-        if dynamic_whitelist:
-            white_content += dynamic_whitelist
-        else:
-            with open(self.env_file_map["DYNAMIC_WHITELIST"], "r") as white_file:
-                white_content += white_file.read()
-        
-        domains = convert.convert_to_domain_list(block_content, white_content)
-        return domains
+        text = os.getenv(env_var, "")
+        if not text:
+            with open(self.env_file_map[env_var], "r") as file:
+                text = file.read()
+        return text
+
+    def download_files(self, known_digests):
+        if self.parse_workers > 1:
+            self.parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+        try:
+            sources = self.extract_sources(known_digests)
+        finally:
+            if self.parse_executor:
+                self.parse_executor.shutdown()
+                self.parse_executor = None
+        if self.cache:
+            self.cache.evict()
+
+        sources["block"]["DYNAMIC_BLACKLIST"] = self.extract_text(
+            self.read_dynamic_list("DYNAMIC_BLACKLIST"), known_digests["block"].get("DYNAMIC_BLACKLIST")
+        )
+        sources["white"]["DYNAMIC_WHITELIST"] = self.extract_text(
+            self.read_dynamic_list("DYNAMIC_WHITELIST"), known_digests["white"].get("DYNAMIC_WHITELIST")
+        )
+        return sources
+
+    def extract_sources(self, known_digests):
+        # Sources are keyed by url, a url listed twice contributes once just
+        # like it did to the union of all sources
+        urls = {
+            "block": list(dict.fromkeys(self.adlist_urls)),
+            "white": list(dict.fromkeys(self.whitelist_urls)),
+        }
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                kind: {url: executor.submit(self.extract_source, url, known_digests[kind].get(url)) for url in urls[kind]}
+                for kind in urls
+            }
+
+        # Every source is waited for, so the error names all that failed
+        failed = [str(future.exception()) for kind in futures for future in futures[kind].values() if future.exception()]
+        if failed:
+            raise SourceUnavailable(f"{len(failed)} sources could not be read and have no cached copy: {'; '.join(failed)}")
+        return {kind: {url: future.result() for url, future in futures[kind].items()} for kind in futures}
+
+    @metrics.timed("domains.process_urls")
+    def process_urls(self):
+        if not self.parsed_cache:
+            sources = self.download_files({"block": {}, "white": {}})
+            block_domains = set().union(*(domains for digest, domains in sources["block"].values()))
+            white_domains = set().union(*(domains for digest, domains in sources["white"].values()))
+            return convert.convert_to_domain_list(block_domains, white_domains)
+
+        # A converter that is kept around (serve) keeps the index in memory
+        # and only reads it from disk once
+        if self.index is None:
+            self.index = DomainIndex(
+                os.path.join(CACHE_DIR, "domain-index.json"), self.parsed_cache.fingerprint
+            ).load()
+        index = self.index
+        sources = self.download_files(index.sources)
+        changed = not index.loaded or bool(index.changed_sources(sources))
+        delta = index.update(sources, self.parsed_cache.load)
+        if delta is None:
+            if any(domains is None for kind in sources for digest, domains in sources[kind].values()):
+                sources = self.download_files({"block": {}, "white": {}})
+            delta = index.rebuild(sources)
+
+        added, removed = delta
+        info(f"Domain list changes since the last run: +{len(added)} -{len(removed)}")
+        metrics.set("domain_delta", {"added": len(added), "removed": len(removed), "total": len(index.final)})
+        if changed:
+            index.save()
+        self.parsed_cache.evict()
+        return index.final
+
+def iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    for chunk in chunks:
+        text = pending + decoder.decode(chunk)
+        lines = text.splitlines()
+        # Hold back a trailing partial line until the next chunk completes it
+        pending = lines.pop() if lines and text[-1] not in LINE_BREAKS else ""
+        yield from lines
+    yield from (pending + decoder.decode(b"", final=True)).splitlines()
+
+def hash_chunks(chunks, body_hash):
+    for chunk in chunks:
+        body_hash.update(chunk)
+        yield chunk
@@ -0,0 +1,193 @@
+import base64
+from array import array
+from operator import add
+from itertools import accumulate, count
+from typing import Iterable, Iterator
+
+ITER_CHUNK_SIZE = 4096
+
+class DomainSet:
+    # Immutable, deduplicated set of domains stored as one ASCII string of
+    # "\n"-separated keys in index order (see convert.domain_to_key) plus an
+    # array of key offsets. At a million domains this is a fraction of the
+    # memory of a set or list of str, membership is a binary search and set
+    # operations merge the two sorted key sequences.
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data: str = "", offsets: array = None):
+        # offsets[i] is where key i starts, offsets[-1] is len(data) + 1
+        self.data = data
+        self.offsets = offsets if offsets is not None else array("I", [0])
+
+    @classmethod
+    def from_keys(cls, keys: Iterable[str]) -> "DomainSet":
+        # keys must already be sorted and unique
+        keys = list(keys)
+        # Each key is followed by one separator: offset i = lengths so far + i
+        offsets = array("I", map(add, accumulate(map(len, keys), initial=0), count()))
+        return cls("\n".join(keys), offsets)
+
+    @classmethod
+    def from_domains(cls, domains: Iterable[str]) -> "DomainSet":
+        return cls.from_keys(sorted({("." + domain)[::-1] for domain in domains}))
+
+    @classmethod
+    def from_json(cls, state: dict) -> "DomainSet":
+        offsets = array("I")
+        offsets.frombytes(base64.b64decode(state["offsets"]))
+        return cls(state["data"], offsets)
+
+    def to_json(self) -> dict:
+        # Storing the offsets saves rebuilding them key by key on load
+        return {"data": self.data, "offsets": base64.b64encode(self.offsets.tobytes()).decode("ascii")}
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __bool__(self) -> bool:
+        return len(self.offsets) > 1
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, DomainSet) and self.data == other.data
+
+    def __repr__(self) -> str:
+        return f"DomainSet({len(self)} domains)"
+
+    def key(self, index: int) -> str:
+        return self.data[self.offsets[index]:self.offsets[index + 1] - 1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("DomainSet slices do not support a step")
+            stop = max(start, stop)
+            base = self.offsets[start]
+            return DomainSet(
+                self.data[base:self.offsets[stop] - 1] if stop > start else "",
+                array("I", (offset - base for offset in self.offsets[start:stop + 1])),
+            )
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DomainSet index out of range")
+        return self.key(index)[-2::-1]
+
+    def keys(self, start: int = 0, stop: int = None) -> list[str]:
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return []
+        return self.data[self.offsets[start]:self.offsets[stop] - 1].split("\n")
+
+    def iter_keys(self) -> Iterator[str]:
+        for start in range(0, len(self), ITER_CHUNK_SIZE):
+            yield from self.keys(start, start + ITER_CHUNK_SIZE)
+
+    def __iter__(self) -> Iterator[str]:
+        for start in range(0, len(self), ITER_CHUNK_SIZE):
+            yield from self.chunk(start, start + ITER_CHUNK_SIZE)
+
+    def chunk(self, start: int, stop: int) -> list[str]:
+        return [key[-2::-1] for key in self.keys(start, stop)]
+
+    def chunks(self, size: int) -> Iterator[list[str]]:
+        for start in range(0, len(self), size):
+            yield self.chunk(start, start + size)
+
+    def bisect(self, key: str, lo: int = 0) -> int:
+        # Position of the first key >= key
+        hi = len(self)
+        data = self.data
+        offsets = self.offsets
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[offsets[mid]:offsets[mid + 1] - 1] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def has_key(self, key: str) -> bool:
+        position = self.bisect(key)
+        return position < len(self) and self.key(position) == key
+
+    def __contains__(self, domain: str) -> bool:
+        return self.has_key(("." + domain)[::-1])
+
+    def subdomain_keys(self, key: str) -> list[str]:
+        # A domain and its subdomains share its key as prefix, so they form
+        # one contiguous range ("." sorts right before "/")
+        start = self.bisect(key)
+        return self.keys(start, self.bisect(key[:-1] + "/", start))
+
+    def merge(self, other: "DomainSet", keep_left: bool, keep_both: bool, keep_right: bool) -> "DomainSet":
+        left = self.iter_keys()
+        right = other.iter_keys()
+        merged = []
+        append = merged.append
+        a = next(left, None)
+        b = next(right, None)
+        while a is not None and b is not None:
+            if a < b:
+                if keep_left:
+                    append(a)
+                a = next(left, None)
+            elif b < a:
+                if keep_right:
+                    append(b)
+                b = next(right, None)
+            else:
+                if keep_both:
+                    append(a)
+                a = next(left, None)
+                b = next(right, None)
+        if keep_left and a is not None:
+            append(a)
+            merged.extend(left)
+        if keep_right and b is not None:
+            append(b)
+            merged.extend(right)
+        return DomainSet.from_keys(merged)
+
+    def __or__(self, other: "DomainSet") -> "DomainSet":
+        return self.merge(other, True, True, True)
+
+    def __and__(self, other: "DomainSet") -> "DomainSet":
+        return self.merge(other, False, True, False)
+
+    def __sub__(self, other: "DomainSet") -> "DomainSet":
+        return self.merge(other, True, False, False)
+
+    def update_keys(self, added: Iterable[str], removed: Iterable[str]) -> "DomainSet":
+        # Returns a copy with a (usually small) delta applied. The unchanged
+        # runs between edits are copied as whole slices of the data and
+        # offsets, so no key outside the delta is materialized.
+        removed = set(removed)
+        edits = dict.fromkeys(removed, False)
+        edits.update((key, True) for key in added if key not in removed)
+        if not edits:
+            return self
+
+        data = f"{self.data}\n" if self.data else ""
+        offsets = self.offsets
+        pieces = []
+        new_offsets = array("I")
+        start = 0
+        shift = 0
+        for key, adding in sorted(edits.items()):
+            position = self.bisect(key, start)
+            if (position < len(self) and self.key(position) == key) == adding:
+                continue
+            pieces.append(data[offsets[start]:offsets[position]])
+            new_offsets.extend(map(shift.__add__, offsets[start:position]))
+            if adding:
+                new_offsets.append(offsets[position] + shift)
+                pieces.append(f"{key}\n")
+                shift += len(key) + 1
+                start = position
+            else:
+                shift -= len(key) + 1
+                start = position + 1
+        pieces.append(data[offsets[start]:])
+        new_offsets.extend(map(shift.__add__, offsets[start:]))
+        return DomainSet("".join(pieces)[:-1], new_offsets)
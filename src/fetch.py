@@ -0,0 +1,172 @@
+import ssl
+import zlib
+import queue
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACCEPT_ENCODING = "gzip, deflate, br" if brotli else "gzip, deflate"
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError,
+)
+
+class ConnectionPool:
+    # Idle keep-alive connections per (scheme, host), most recently used
+    # first so that the connections least likely to have gone stale are
+    # reused. Shared by the Gateway client and the source downloads.
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.context = ssl.create_default_context()
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, host, timeout):
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, context=self.context, timeout=timeout)
+        return http.client.HTTPConnection(host, timeout=timeout)
+
+    def acquire(self, scheme, host, timeout):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), queue.LifoQueue(maxsize=self.pool_size))
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            return self.connect(scheme, host, timeout), False
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), queue.LifoQueue(maxsize=self.pool_size))
+        try:
+            idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            pools = list(self.idle.values())
+        for idle in pools:
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def request(self, scheme, host, method, path, body, headers, timeout):
+        # Returns (conn, response) with the body still unread. The caller
+        # hands the connection back with finish() once it has read it.
+        conn, reused = self.acquire(scheme, host, timeout)
+        try:
+            conn.request(method, path, body, headers)
+            return conn, conn.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+        except Exception:
+            conn.close()
+            raise
+        # The server dropped an idle keep-alive connection, retry once on a fresh one
+        conn = self.connect(scheme, host, timeout)
+        try:
+            conn.request(method, path, body, headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def finish(self, scheme, host, conn, response):
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self.release(scheme, host, conn)
+
+class IdentityDecoder:
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+class DeflateDecoder:
+    # "deflate" is meant to be zlib-wrapped, but some servers send a raw
+    # deflate stream, so the first chunk decides which one it is
+    def __init__(self):
+        self.decoder = None
+
+    def decompress(self, data):
+        if self.decoder is None:
+            self.decoder = zlib.decompressobj()
+            try:
+                return self.decoder.decompress(data)
+            except zlib.error:
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decoder.decompress(data)
+
+    def flush(self):
+        return self.decoder.flush() if self.decoder else b""
+
+class BrotliDecoder:
+    def __init__(self):
+        self.decoder = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self.decoder.process(data)
+
+    def flush(self):
+        return b""
+
+def decoder_for(content_encoding):
+    content_encoding = (content_encoding or "identity").strip().lower()
+    if content_encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        return DeflateDecoder()
+    if content_encoding == "br" and brotli:
+        return BrotliDecoder()
+    if content_encoding == "identity":
+        return IdentityDecoder()
+    raise http.client.HTTPException(f"unsupported Content-Encoding: {content_encoding}")
+
+def iter_body(response, chunk_size=65536):
+    # Decompresses the body chunk by chunk as it arrives
+    decoder = decoder_for(response.getheader("Content-Encoding"))
+    while chunk := response.read(chunk_size):
+        if data := decoder.decompress(chunk):
+            yield data
+    if data := decoder.flush():
+        yield data
+
+def read_body(response):
+    return b"".join(iter_body(response))
+
+def open_url(pool, url, headers, timeout, max_redirects=MAX_REDIRECTS):
+    # GETs url, following redirects, and returns (final url, conn, response)
+    # with the body unread. Every redirect response is drained so its
+    # connection goes back to the pool.
+    headers = {"Accept-Encoding": ACCEPT_ENCODING, **headers}
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        conn, response = pool.request(parts.scheme, parts.netloc, "GET", path, None, headers, timeout)
+        location = response.getheader("Location")
+        if response.status not in REDIRECT_STATUSES or not location:
+            return url, conn, response
+        try:
+            response.read()
+        except Exception:
+            conn.close()
+            raise
+        pool.finish(parts.scheme, parts.netloc, conn, response)
+        url = urljoin(url, location)
+    raise http.client.HTTPException(f"more than {max_redirects} redirects")
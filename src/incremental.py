@@ -0,0 +1,181 @@
+import os
+import json
+from collections import Counter
+from src.metrics import metrics
+from src.domainset import DomainSet
+from src import info, silent_error, convert, WHITELIST_SUBDOMAINS
+
+class DomainIndex:
+    # Final domain list maintained incrementally between runs. Every domain
+    # keeps a count of the sources that contribute it, so a changed source
+    # only applies the lines it gained or lost, and only those domains and
+    # their subdomains are re-checked against the collapse rules:
+    #
+    #   a blocked domain is final when it is not whitelisted and none of its
+    #   parents is blocked (or whitelisted, with WHITELIST_SUBDOMAINS)
+    #
+    # Counts are keyed by index key (see convert.domain_to_key), and the
+    # blocked and final domains are kept as DomainSets, where each domain's
+    # subdomains form one contiguous range.
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = f"{fingerprint}-{int(WHITELIST_SUBDOMAINS)}"
+        self.reset()
+
+    def reset(self):
+        self.sources = {"block": {}, "white": {}}
+        self.block = {}
+        self.white = {}
+        self.blocked = DomainSet()
+        self.final = DomainSet()
+        self.loaded = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError) as e:
+            silent_error(f"Ignoring unreadable domain index {self.path}: {e}")
+            return self
+
+        self.final = DomainSet.from_json(state["final"])
+        # Parse results from other parsing rules can't be diffed against
+        # today's, keep only the final list to report the delta against
+        if state.get("fingerprint") == self.fingerprint:
+            self.sources = state["sources"]
+            self.blocked = DomainSet.from_json(state["block"])
+            self.block = dict.fromkeys(self.blocked.keys(), 1)
+            self.block.update(state["block_counts"])
+            self.white = dict.fromkeys(state["white"], 1)
+            self.white.update(state["white_counts"])
+            self.loaded = True
+        return self
+
+    def save(self):
+        # Strings and lists load much faster than large objects, so the
+        # DomainSets are stored whole and only counts above one per key
+        state = {
+            "fingerprint": self.fingerprint,
+            "sources": self.sources,
+            "block": self.blocked.to_json(),
+            "block_counts": {key: count for key, count in self.block.items() if count > 1},
+            "white": list(self.white),
+            "white_counts": {key: count for key, count in self.white.items() if count > 1},
+            "final": self.final.to_json(),
+        }
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def changed_sources(self, sources):
+        # sources: {"block": {id: (digest, domains)}, "white": {...}}, where
+        # domains may be None for a source whose digest did not change
+        return [
+            (kind, source_id)
+            for kind in ("block", "white")
+            for source_id in set(sources[kind]) | set(self.sources[kind])
+            if source_id not in sources[kind]
+            or source_id not in self.sources[kind]
+            or sources[kind][source_id][0] != self.sources[kind][source_id]
+        ]
+
+    @metrics.timed("incremental.update")
+    def update(self, sources, load_domains):
+        # Returns (added, removed), or None when a changed source's previous
+        # domains are no longer available and the index has to be rebuilt
+        if not self.loaded:
+            return None
+
+        changes = []
+        for kind, source_id in self.changed_sources(sources):
+            old_digest = self.sources[kind].get(source_id)
+            old_domains = load_domains(old_digest) if old_digest else set()
+            if old_domains is None:
+                info(f"Previous domains of {source_id} are no longer cached, rebuilding the domain index")
+                return None
+            new_digest, new_domains = sources[kind].get(source_id, (None, set()))
+            if source_id in sources[kind] and not new_digest:
+                raise ValueError(f"Source {source_id} has no digest to record")
+            changes.append((kind, source_id, new_digest, old_domains, new_domains))
+
+        touched = set()
+        for kind, source_id, new_digest, old_domains, new_domains in changes:
+            counts = self.block if kind == "block" else self.white
+            for domain in new_domains - old_domains:
+                key = convert.domain_to_key(domain)
+                count = counts.get(key, 0)
+                counts[key] = count + 1
+                if not count:
+                    touched.add(key)
+            for domain in old_domains - new_domains:
+                key = convert.domain_to_key(domain)
+                count = counts.pop(key) - 1
+                if count:
+                    counts[key] = count
+                else:
+                    touched.add(key)
+            if source_id in sources[kind]:
+                self.sources[kind][source_id] = new_digest
+            else:
+                del self.sources[kind][source_id]
+
+        self.blocked = self.blocked.update_keys(
+            [key for key in touched if key in self.block],
+            [key for key in touched if key not in self.block],
+        )
+
+        # A domain entering or leaving the index can uncover or cover any of
+        # its subdomains, so those are re-checked along with it
+        affected = set(touched)
+        for key in touched:
+            affected.update(self.blocked.subdomain_keys(key))
+
+        added = {key for key in affected if not self.final.has_key(key) and self.is_final(key)}
+        removed = {key for key in affected if self.final.has_key(key) and not self.is_final(key)}
+        self.final = self.final.update_keys(added, removed)
+
+        info(
+            f"Updated domain index from {len(changes)} changed sources: "
+            f"{len(touched)} domains touched, +{len(added)} -{len(removed)} final domains"
+        )
+        return {convert.key_to_domain(key) for key in added}, {convert.key_to_domain(key) for key in removed}
+
+    def is_final(self, key):
+        if key not in self.block or key in self.white:
+            return False
+        # Every "." before the last one ends the key of a parent domain
+        end = key.find(".")
+        while end < len(key) - 1:
+            parent = key[:end + 1]
+            if parent in self.block or (WHITELIST_SUBDOMAINS and parent in self.white):
+                return False
+            end = key.find(".", end + 1)
+        return True
+
+    @metrics.timed("incremental.rebuild")
+    def rebuild(self, sources):
+        for kind in ("block", "white"):
+            for source_id, (digest, source_domains) in sources[kind].items():
+                if not digest:
+                    raise ValueError(f"Source {source_id} has no digest to record")
+        previous = self.final
+        self.reset()
+        for kind in ("block", "white"):
+            counts = Counter()
+            for source_id, (digest, source_domains) in sources[kind].items():
+                self.sources[kind][source_id] = digest
+                counts.update(("." + domain)[::-1] for domain in source_domains)
+            setattr(self, kind, dict(counts))
+
+        block_keys = sorted(self.block)
+        self.blocked = DomainSet.from_keys(block_keys)
+        self.final = convert.collapse_domain_keys(block_keys, set(self.white))
+        self.loaded = True
+        info(
+            f"Rebuilt domain index: {len(self.block)} blocked, {len(self.white)} whitelisted, "
+            f"{len(self.final)} final domains"
+        )
+        return set(self.final - previous), set(previous - self.final)
@@ -0,0 +1,163 @@
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.perf_counter()
+            self.timings = {}
+            self.endpoints = {}
+            self.retries = {}
+            self.downloads = {}
+            self.extra = {}
+
+    def record_timing(self, name, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["seconds"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_timing(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_request(self, method, endpoint, status, seconds, bytes_out, bytes_in):
+        # Collapse ids and query strings so requests group per endpoint
+        path = re.sub(r"/[0-9a-fA-F-]{32,36}", "/{id}", endpoint.split("?")[0])
+        key = f"{method} {path}"
+        with self.lock:
+            stats = self.endpoints.setdefault(key, {
+                "count": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "bytes_out": 0, "bytes_in": 0,
+            })
+            stats["count"] += 1
+            stats["errors"] += 1 if status is None or status >= 400 else 0
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["bytes_out"] += bytes_out
+            stats["bytes_in"] += bytes_in
+
+    def record_download(self, url, seconds, size, cached):
+        with self.lock:
+            self.downloads[url] = {"seconds": seconds, "bytes": size, "cached": cached}
+
+    def record_retry(self, name, sleep_seconds):
+        with self.lock:
+            stats = self.retries.setdefault(name, {"count": 0, "sleep_seconds": 0.0, "gave_up": 0})
+            stats["count"] += 1
+            stats["sleep_seconds"] += sleep_seconds
+
+    def record_retry_exhausted(self, name):
+        with self.lock:
+            stats = self.retries.setdefault(name, {"count": 0, "sleep_seconds": 0.0, "gave_up": 0})
+            stats["gave_up"] += 1
+
+    def set(self, key, value):
+        with self.lock:
+            self.extra[key] = value
+
+    def report(self):
+        with self.lock:
+            endpoints = {key: dict(stats) for key, stats in self.endpoints.items()}
+            for stats in endpoints.values():
+                stats["mean"] = stats["seconds"] / stats["count"]
+            return {
+                "wall_seconds": time.perf_counter() - self.started,
+                "timings": {key: dict(timing) for key, timing in self.timings.items()},
+                "requests": {
+                    "count": sum(stats["count"] for stats in endpoints.values()),
+                    "bytes_out": sum(stats["bytes_out"] for stats in endpoints.values()),
+                    "bytes_in": sum(stats["bytes_in"] for stats in endpoints.values()),
+                    "endpoints": endpoints,
+                },
+                "downloads": {
+                    "count": len(self.downloads),
+                    "bytes": sum(stats["bytes"] for stats in self.downloads.values()),
+                    "cached": sum(1 for stats in self.downloads.values() if stats["cached"]),
+                    "sources": {key: dict(stats) for key, stats in self.downloads.items()},
+                },
+                "retries": {
+                    "count": sum(stats["count"] for stats in self.retries.values()),
+                    "sleep_seconds": sum(stats["sleep_seconds"] for stats in self.retries.values()),
+                    "gave_up": sum(stats["gave_up"] for stats in self.retries.values()),
+                    "functions": {key: dict(stats) for key, stats in self.retries.items()},
+                },
+                **self.extra,
+            }
+
+    def write(self, path):
+        data = json.dumps(self.report(), indent=2, sort_keys=True)
+        if path == "-":
+            print(data)
+        else:
+            with open(path, "w") as f:
+                f.write(data)
+
+class ThreadProfiler:
+    # cProfile only sees the thread that enabled it, while parsing, remote
+    # reads and API calls all run on worker pools. threading.setprofile
+    # hooks every thread started afterwards, which then swaps in its own
+    # cProfile.Profile. stats() merges them into one pstats.Stats.
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def add_profile(self):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        return profile
+
+    def start_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        self.add_profile().enable()
+
+    def enable(self):
+        threading.setprofile(self.start_thread)
+        self.add_profile().enable()
+
+    def disable(self):
+        threading.setprofile(None)
+        sys.setprofile(None)
+
+    def stats(self):
+        # Threads that are still running are cut off where they are, and
+        # threads that never called a Python function have nothing to add
+        stats = None
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+metrics = Metrics()
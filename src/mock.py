@@ -0,0 +1,161 @@
+import re
+import json
+import time
+import uuid
+import random
+import threading
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src import MAX_LIST_SIZE
+
+class MockGateway:
+    # In-process stand-in for the /gateway/lists and /gateway/rules endpoints,
+    # used by `--mock` to plan, benchmark and test syncs without credentials
+    def __init__(self, latency=0.0, throttle=0.0, retry_after=1, page_size=MAX_LIST_SIZE, seed=0, outage=0.0):
+        self.latency = latency
+        self.throttle = throttle
+        self.outage = outage
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lists = {}
+        self.rules = {}
+        self.requests = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def start(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, payload, headers = gateway.handle(self.command, self.path, body)
+                data = json.dumps(payload).encode("utf-8")
+                with gateway.lock:
+                    gateway.bytes_in += len(body)
+                    gateway.bytes_out += len(data)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def handle(self, method, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        parsed_url = urllib.parse.urlparse(path)
+        query = urllib.parse.parse_qs(parsed_url.query)
+        match = re.match(r"^/client/v4/accounts/[^/]+/gateway(/.*)$", parsed_url.path)
+        if not match:
+            return self.reply(404, None)
+        endpoint = match.group(1)
+        data = json.loads(body) if body else {}
+
+        with self.lock:
+            self.requests[(method, re.sub(r"/[0-9a-f-]{36}", "/{id}", endpoint))] += 1
+            if self.throttle and self.random.random() < self.throttle:
+                return 429, self.envelope(None, success=False), {"Retry-After": str(self.retry_after)}
+            if self.outage and self.random.random() < self.outage:
+                return self.reply(503, None)
+            return self.route(method, endpoint, query, data)
+
+    def route(self, method, endpoint, query, data):
+        if endpoint == "/lists":
+            if method == "GET":
+                return self.reply(200, [self.list_info(list_id) for list_id in self.lists])
+            if method == "POST":
+                list_id = str(uuid.uuid4())
+                self.lists[list_id] = {
+                    "name": data["name"],
+                    "description": data.get("description", ""),
+                    "type": data.get("type", "DOMAIN"),
+                    "items": [item["value"] for item in data.get("items", [])],
+                }
+                return self.reply(200, self.list_info(list_id))
+
+        match = re.match(r"^/lists/([^/]+)(/items)?$", endpoint)
+        if match and match.group(1) in self.lists:
+            list_id = match.group(1)
+            items = self.lists[list_id]["items"]
+            if match.group(2) and method == "GET":
+                limit = min(int(query.get("limit", [self.page_size])[0]), self.page_size)
+                start = int(query.get("cursor", ["0"])[0])
+                page = items[start:start + limit]
+                end = start + len(page)
+                cursors = {"after": str(end)} if end < len(items) else {}
+                return self.reply(200, [{"value": value} for value in page], {"cursors": cursors})
+            if not match.group(2) and method == "PATCH":
+                removed = set(data.get("remove", []))
+                items[:] = [value for value in items if value not in removed]
+                items.extend(item["value"] for item in data.get("append", []))
+                return self.reply(200, self.list_info(list_id))
+            if not match.group(2) and method == "DELETE":
+                del self.lists[list_id]
+                return self.reply(200, {"id": list_id})
+
+        if endpoint == "/rules":
+            if method == "GET":
+                return self.reply(200, [dict(rule, id=rule_id) for rule_id, rule in self.rules.items()])
+            if method == "POST":
+                rule_id = str(uuid.uuid4())
+                self.rules[rule_id] = data
+                return self.reply(200, dict(data, id=rule_id))
+
+        match = re.match(r"^/rules/([^/]+)$", endpoint)
+        if match and match.group(1) in self.rules:
+            rule_id = match.group(1)
+            if method == "PUT":
+                self.rules[rule_id] = data
+                return self.reply(200, dict(data, id=rule_id))
+            if method == "DELETE":
+                del self.rules[rule_id]
+                return self.reply(200, {"id": rule_id})
+
+        return self.reply(404, None)
+
+    def list_info(self, list_id):
+        list_item = self.lists[list_id]
+        return {
+            "id": list_id,
+            "name": list_item["name"],
+            "description": list_item["description"],
+            "type": list_item["type"],
+            "count": len(list_item["items"]),
+        }
+
+    def envelope(self, result, result_info=None, success=True):
+        payload = {"success": success, "errors": [], "messages": [], "result": result}
+        if result_info is not None:
+            payload["result_info"] = result_info
+        return payload
+
+    def reply(self, status, result, result_info=None):
+        return status, self.envelope(result, result_info, success=status < 400), {}
@@ -1,82 +1,313 @@
 import ssl
-import gzip
 import json
 import time
 import random
 import http.client
 import socket
+import threading
 import urllib.parse
-import zlib
-from io import BytesIO
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from functools import wraps
 from typing import Optional, Tuple
-from src import info, silent_error, error, RATE_LIMIT_INTERVAL, CF_IDENTIFIER, CF_API_TOKEN
+from src.metrics import metrics
+from src.fetch import ConnectionPool, ACCEPT_ENCODING, read_body
+from src import (
+    info, silent_error,
+    RATE_LIMIT, RATE_LIMIT_MAX, RATE_LIMIT_MIN, RATE_LIMIT_BURST,
+    CONNECTION_POOL_SIZE, CF_IDENTIFIER, CF_API_TOKEN, CF_API_URL,
+    RETRY_MAX_ATTEMPTS, RETRY_CALL_TIMEOUT, RETRY_BUDGET,
+    CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN,
+)
 
 class HTTPException(Exception):
-    pass
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
 
-def cloudflare_gateway_request(method: str, endpoint: str, body: Optional[str] = None, timeout: int = 10) -> Tuple[int, dict]:
-    context = ssl.create_default_context()
-    conn = http.client.HTTPSConnection("api.cloudflare.com", context=context, timeout=timeout)
+    @property
+    def retryable(self):
+        # Network errors, throttling and server errors may go away, other
+        # client errors will fail the same way again
+        return self.status is None or self.status == 429 or self.status >= 500
+
+class CircuitOpenError(HTTPException):
+    retryable = False
+
+class RateLimiter:
+    # Token bucket shared by every Gateway call. The refill rate grows
+    # additively while the API is healthy and is halved on 429/5xx, and a
+    # Retry-After header pauses all callers until it has elapsed.
+    def __init__(self, rate, max_rate, min_rate, burst):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.blocked_until = 0.0
+        self.total_wait = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    @property
+    def wait_time(self):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return max(self.blocked_until - now, -min(0, self.tokens - 1) / self.rate, 0)
+
+    def wait_for_next_request(self):
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            # Reserve a token now and sleep off any deficit outside the lock
+            self.tokens -= 1
+            sleep_time = max(self.blocked_until - now, -min(0, self.tokens) / self.rate, 0)
+            self.total_wait += sleep_time
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.min_rate)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        info(
+            f"Throttled by Cloudflare, slowing down to {self.rate:.2f} requests/s"
+            + (f", pausing for {retry_after:.1f}s" if retry_after else "")
+        )
+
+rate_limiter = RateLimiter(RATE_LIMIT, RATE_LIMIT_MAX, RATE_LIMIT_MIN, RATE_LIMIT_BURST)
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive server or network errors and then
+    # fails calls at once instead of queueing them behind retries. After
+    # `cooldown` seconds a single trial call is let through, closing the
+    # breaker again if it succeeds and reopening it if it fails. A trial
+    # that ends either way (a 429, an undecodable body) lets the next call
+    # try again.
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trips = 0
+        self.lock = threading.Lock()
 
-    headers = {
-        "Authorization": f"Bearer {CF_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Accept-Encoding": "gzip, deflate"
-    }
+    def before_call(self):
+        # Returns whether this call is the trial, which the caller must end
+        # with end_trial() however it turns out
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError(
+                    f"Circuit breaker open after {self.failures} consecutive failures", retry_after=max(0, remaining)
+                )
+            self.trial = True
+            return True
 
-    url = f"/client/v4/accounts/{CF_IDENTIFIER}/gateway{endpoint}"
-    full_url = f"https://api.cloudflare.com{url}"
+    def end_trial(self):
+        with self.lock:
+            self.trial = False
 
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                silent_error(
+                    f"Cloudflare API failing, opening the circuit breaker for {self.cooldown:.0f}s "
+                    f"after {self.failures} consecutive failures"
+                )
+            self.trial = False
+
+class RetryBudget:
+    # Retries left for the whole run, shared by every call, and the point in
+    # time after which no call starts another retry
+    def __init__(self, retries):
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, deadline=None):
+        with self.lock:
+            self.remaining = self.retries
+            self.deadline = deadline
+
+    def spend(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+retry_budget = RetryBudget(RETRY_BUDGET)
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        conn.request(method, url, body, headers)
-        response = conn.getresponse()
-        data = response.read()
-        status = response.status
-
-        content_encoding = response.getheader('Content-Encoding')
-        if content_encoding == 'gzip':
-            buf = BytesIO(data)
-            with gzip.GzipFile(fileobj=buf) as f:
-                data = f.read()
-        elif content_encoding == 'deflate':
-            data = zlib.decompress(data)
-
-        if status >= 400:
-            error_message = f"Request failed: {status} {response.reason}, Body: {data.decode('utf-8', errors='ignore')} for url: {full_url}"
-            if status == 400:
-                error(error_message)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class CloudflareClient:
+    def __init__(self, account_id, api_token, base_url=CF_API_URL, pool_size=CONNECTION_POOL_SIZE, limiter=rate_limiter):
+        self.account_id = account_id
+        self.api_token = api_token
+        self.base_url = base_url.rstrip("/")
+        parsed_url = urllib.parse.urlparse(self.base_url)
+        self.scheme = parsed_url.scheme
+        self.host = parsed_url.netloc
+        self.rate_limiter = limiter
+        self.breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN)
+        self.pool = ConnectionPool(pool_size)
+
+    def close(self):
+        self.pool.close()
+
+    def send(self, method, url, body, headers, timeout):
+        conn, response = self.pool.request(self.scheme, self.host, method, url, body, headers, timeout)
+        try:
+            data = read_body(response)
+        except Exception:
+            conn.close()
+            raise
+        self.pool.finish(self.scheme, self.host, conn, response)
+        return response, data
+
+    def request(self, method: str, endpoint: str, body: Optional[str] = None, timeout: int = 10) -> Tuple[int, dict]:
+        headers = {
+            "Authorization": f"Bearer {self.api_token}",
+            "Content-Type": "application/json",
+            "Accept-Encoding": ACCEPT_ENCODING,
+        }
+
+        url = f"/client/v4/accounts/{self.account_id}/gateway{endpoint}"
+        full_url = f"{self.base_url}{url}"
+
+        status = None
+        data = b""
+        trial = self.breaker.before_call()
+        self.rate_limiter.wait_for_next_request()
+        start = time.perf_counter()
+        try:
+            response, data = self.send(method, url, body, headers, timeout)
+            status = response.status
+            if status == 429 or status >= 500:
+                retry_after = parse_retry_after(response.getheader('Retry-After'))
+                self.rate_limiter.on_throttle(retry_after)
             else:
+                retry_after = None
+                self.rate_limiter.on_success()
+            if status >= 500:
+                self.breaker.on_failure()
+            elif status != 429:
+                self.breaker.on_success()
+
+            if status >= 400:
+                error_message = f"Request failed: {status} {response.reason}, Body: {data.decode('utf-8', errors='ignore')} for url: {full_url}"
                 silent_error(error_message)
+                raise HTTPException(error_message, status, retry_after)
+
+            return status, json.loads(data.decode('utf-8'))
+
+        except (http.client.HTTPException, ssl.SSLError, socket.timeout, OSError) as e:
+            error_message = f"Network error occurred: {e}"
+            info(error_message)
+            self.breaker.on_failure()
+            raise HTTPException(error_message)
+        except json.JSONDecodeError:
+            error_message = "Failed to decode JSON response"
+            info(error_message)
             raise HTTPException(error_message)
+        finally:
+            if trial:
+                self.breaker.end_trial()
+            metrics.record_request(
+                method, endpoint, status, time.perf_counter() - start,
+                len(body.encode('utf-8')) if body else 0, len(data),
+            )
 
-        return status, json.loads(data.decode('utf-8'))
+client = CloudflareClient(CF_IDENTIFIER, CF_API_TOKEN)
 
-    except (http.client.HTTPException, ssl.SSLError, socket.timeout, OSError) as e:
-        error_message = f"Network error occurred: {e}"
-        info(error_message)
-        raise HTTPException(error_message)
-    except json.JSONDecodeError:
-        error_message = "Failed to decode JSON response"
-        info(error_message)
-        raise HTTPException(error_message)
+# Client used by the calls in src.cloudflare. It is the module-level client
+# unless a target's sync has switched its context to that target's client.
+active_client = contextvars.ContextVar("active_client")
+
+def current_client() -> CloudflareClient:
+    return active_client.get(client)
+
+@contextmanager
+def use_client(cloudflare_client):
+    token = active_client.set(cloudflare_client)
+    try:
+        yield cloudflare_client
     finally:
-        conn.close()
+        active_client.reset(token)
 
-def stop_never(attempt_number):
+def cloudflare_gateway_request(method: str, endpoint: str, body: Optional[str] = None, timeout: int = 10) -> Tuple[int, dict]:
+    return current_client().request(method, endpoint, body, timeout)
+
+def stop_never(retry_state):
     return False
 
+def stop_after_attempt(max_attempts):
+    return lambda retry_state: retry_state['attempt_number'] >= max_attempts
+
+def stop_after_delay(max_delay):
+    # Stop before a sleep that would end past max_delay seconds into the call
+    return lambda retry_state: retry_state['elapsed'] + retry_state['next_sleep'] > max_delay
+
+def stop_at_deadline(budget):
+    return lambda retry_state: (
+        budget.deadline is not None and time.monotonic() + retry_state['next_sleep'] > budget.deadline
+    )
+
+def stop_when_spent(budget):
+    # Last in stop_any, so a retry is only charged when nothing else stops it
+    return lambda retry_state: not budget.spend()
+
+def stop_any(*stops):
+    return lambda retry_state: any(stop(retry_state) for stop in stops)
+
 def wait_random_exponential(attempt_number, multiplier=1, max_wait=10):
     return min(multiplier * (2 ** random.uniform(0, attempt_number - 1)), max_wait)
 
-def retry_if_exception_type(exceptions):
-    return lambda e: isinstance(e, exceptions)
+def retry_if_retryable(e):
+    return isinstance(e, HTTPException) and e.retryable
 
 def retry(stop=None, wait=None, retry=None, after=None, before_sleep=None):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             attempt_number = 0
+            start = time.monotonic()
             while True:
                 try:
                     attempt_number += 1
@@ -86,44 +317,42 @@ def retry(stop=None, wait=None, retry=None, after=None, before_sleep=None):
                         raise
                     if after:
                         after({'attempt_number': attempt_number, 'outcome': e})
-                    if stop and stop(attempt_number):
+                    wait_time = wait(attempt_number) if wait else 1
+                    # Honor the server's Retry-After instead of guessing
+                    if getattr(e, 'retry_after', None) is not None:
+                        wait_time = e.retry_after
+                    retry_state = {
+                        'attempt_number': attempt_number,
+                        'elapsed': time.monotonic() - start,
+                        'next_sleep': wait_time,
+                        'outcome': e,
+                    }
+                    if stop and stop(retry_state):
+                        metrics.record_retry_exhausted(func.__name__)
                         raise
                     if before_sleep:
-                        before_sleep({'attempt_number': attempt_number})
-                    wait_time = wait(attempt_number) if wait else 1
+                        before_sleep(retry_state)
+                    metrics.record_retry(func.__name__, wait_time)
                     time.sleep(wait_time)
         return wrapper
     return decorator
 
 retry_config = {
-    'stop': stop_never,
+    'stop': stop_any(
+        stop_after_attempt(RETRY_MAX_ATTEMPTS),
+        stop_after_delay(RETRY_CALL_TIMEOUT),
+        stop_at_deadline(retry_budget),
+        stop_when_spent(retry_budget),
+    ),
     'wait': lambda attempt_number: wait_random_exponential(
         attempt_number, multiplier=1, max_wait=10
     ),
-    'retry': retry_if_exception_type((HTTPException,)),
+    'retry': retry_if_retryable,
     'before_sleep': lambda retry_state: info(
-        f"Sleeping before next retry ({retry_state['attempt_number']})"
+        f"Sleeping {retry_state['next_sleep']:.1f}s before next retry ({retry_state['attempt_number']}), "
+        f"rate limit {current_client().rate_limiter.rate:.2f} requests/s, "
+        f"next request in {current_client().rate_limiter.wait_time:.1f}s, "
+        f"{current_client().rate_limiter.total_wait:.1f}s spent waiting so far, "
+        f"{retry_budget.remaining} retries left"
     )
 }
-
-class RateLimiter:
-    def __init__(self, interval):
-        self.interval = interval
-        self.timestamp = time.time()
-
-    def wait_for_next_request(self):
-        now = time.time()
-        elapsed = now - self.timestamp
-        sleep_time = max(0, self.interval - elapsed)
-        if sleep_time > 0:
-            time.sleep(sleep_time)
-        self.timestamp = time.time()
-
-rate_limiter = RateLimiter(RATE_LIMIT_INTERVAL)
-
-def rate_limited_request(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        rate_limiter.wait_for_next_request()
-        return func(*args, **kwargs)
-    return wrapper
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+from src import utils, info, silent_error
+
+class Manifest:
+    # Local copy of every list this tool manages. Changes made while a sync
+    # is running go to an append-only journal next to it first, so a run
+    # that is killed halfway resumes from the last completed operation.
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.lists = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.lists = json.load(f).get("lists", {})
+        except FileNotFoundError:
+            self.lists = {}
+        except (OSError, ValueError) as e:
+            silent_error(f"Ignoring unreadable manifest {self.path}: {e}")
+            self.lists = {}
+        self.replay()
+        self.loaded = True
+        return self
+
+    def replay(self):
+        try:
+            with open(self.journal_path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        planned = completed = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be torn if the run was killed mid-write
+                break
+            if entry["op"] == "plan":
+                planned += entry["operations"]
+            elif entry["op"] == "update":
+                self.update(entry["id"], entry["name"], entry["domains"])
+                completed += 1
+            elif entry["op"] == "remove":
+                self.remove(entry["id"])
+                completed += 1
+        info(f"Resuming an interrupted sync: {completed} of {planned} planned operations had completed")
+
+    def save(self):
+        # A saved manifest is a checkpoint, the journal before it is obsolete
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self.lock:
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump({"lists": self.lists}, f)
+            os.replace(f"{self.path}.tmp", self.path)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def journal(self, entry):
+        with self.lock:
+            with open(self.journal_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def log_plan(self, operations):
+        self.journal({"op": "plan", "operations": operations})
+
+    def log_update(self, list_id, name, domains):
+        self.journal({"op": "update", "id": list_id, "name": name, "domains": list(domains)})
+        with self.lock:
+            self.update(list_id, name, domains)
+
+    def log_remove(self, list_id):
+        self.journal({"op": "remove", "id": list_id})
+        with self.lock:
+            self.remove(list_id)
+
+    def trusted_items(self, list_item):
+        # Cheap drift check: only trust an entry if the remote list still has
+        # the same name and item count and the stored domains are intact
+        entry = self.lists.get(list_item["id"])
+        if (
+            entry
+            and entry["name"] == list_item["name"]
+            and entry["count"] == list_item.get("count")
+            and entry["hash"] == utils.hash_list(entry["domains"])
+        ):
+            return entry["domains"]
+        return None
+
+    def update(self, list_id, name, domains):
+        self.lists[list_id] = {
+            "name": name,
+            "count": len(domains),
+            "hash": utils.hash_list(domains),
+            "domains": list(domains),
+        }
+
+    def remove(self, list_id):
+        self.lists.pop(list_id, None)
+
+    def retain(self, expected_items):
+        self.lists = {
+            list_id: entry for list_id, entry in self.lists.items()
+            if list_id in expected_items
+            and entry["hash"] == utils.hash_list(expected_items[list_id])
+        }
@@ -0,0 +1,60 @@
+import os
+from configparser import ConfigParser
+from src.requests import CloudflareClient, RateLimiter
+from src import (
+    error, env_vars,
+    PREFIX, MAX_LISTS, CF_API_URL, CONNECTION_POOL_SIZE,
+    RATE_LIMIT, RATE_LIMIT_MAX, RATE_LIMIT_MIN, RATE_LIMIT_BURST,
+)
+
+class Target:
+    # One account and policy prefix to keep in sync. Each target has its
+    # own client, so its own connection pool and rate limiter, and its own
+    # manifest (keyed by account id and prefix).
+    def __init__(self, name, client, prefix=PREFIX, max_lists=MAX_LISTS):
+        self.name = name
+        self.client = client
+        self.prefix = prefix
+        self.max_lists = max_lists
+
+def read_secret(section, key):
+    # Tokens can be written inline, or named by the environment (or .env)
+    # variable that holds them so the file itself can be committed
+    if section.get(f"{key}_env"):
+        variable = section[f"{key}_env"]
+        return os.getenv(variable) or env_vars.get(variable)
+    return section.get(key)
+
+def load_targets(path):
+    # Every section of the file is a target:
+    #
+    #   [home]
+    #   account_id = 0123456789abcdef0123456789abcdef
+    #   api_token_env = CF_API_TOKEN_HOME
+    #   prefix = AdBlock-DNS-Filters
+    #   max_lists = 300
+    #   rate_limit = 1.0
+    config = ConfigParser()
+    if not config.read(path):
+        error(f"Could not read targets file {path}")
+
+    targets = []
+    for name in config.sections():
+        section = config[name]
+        account_id = section.get("account_id")
+        api_token = read_secret(section, "api_token")
+        if not account_id or not api_token:
+            error(f"Target {name} in {path} needs an account_id and an api_token or api_token_env")
+        limiter = RateLimiter(
+            section.getfloat("rate_limit", RATE_LIMIT), RATE_LIMIT_MAX, RATE_LIMIT_MIN, RATE_LIMIT_BURST
+        )
+        client = CloudflareClient(
+            account_id, api_token, section.get("api_url", CF_API_URL), CONNECTION_POOL_SIZE, limiter
+        )
+        targets.append(Target(
+            name, client, section.get("prefix", PREFIX), section.getint("max_lists", MAX_LISTS)
+        ))
+
+    if not targets:
+        error(f"No targets defined in {path}")
+    return targets
@@ -1,13 +1,37 @@
 import re
 import time
 import hashlib
+from itertools import islice
 from src import MAX_LIST_SIZE
 
 def split_domain_list(domain_list):
-    return [
-        domain_list[i : i + MAX_LIST_SIZE]
-        for i in range(0, len(domain_list), MAX_LIST_SIZE)
-    ]
+    return list(domain_list.chunks(MAX_LIST_SIZE))
+
+def assign_domain_list(domain_list, current_chunks):
+    # Domains stay in the list they were assigned to last time, so a change
+    # only touches the lists that lost a domain or have room for a new one.
+    # domain_list is a DomainSet, it is only ever iterated, never copied
+    # into a set of its own.
+    current_domains = set().union(*current_chunks.values())
+    remaining = {domain for domain in domain_list if domain in current_domains}
+
+    chunks = {}
+    for index in sorted(current_chunks):
+        kept = [domain for domain in current_chunks[index] if domain in remaining]
+        remaining.difference_update(kept)
+        chunks[index] = kept
+
+    new_domains = (domain for domain in domain_list if domain not in current_domains)
+    for index in sorted(chunks):
+        chunks[index].extend(islice(new_domains, max(0, MAX_LIST_SIZE - len(chunks[index]))))
+
+    index = 1
+    while batch := list(islice(new_domains, MAX_LIST_SIZE)):
+        while index in chunks:
+            index += 1
+        chunks[index] = batch
+
+    return {index: chunk for index, chunk in sorted(chunks.items()) if chunk}
 
 def create_list_payload(name, chunk_list):
     return {
@@ -17,6 +41,20 @@ def create_list_payload(name, chunk_list):
         "items": [{"value": domain} for domain in chunk_list],
     }
 
+def create_patch_payload(current_items, new_items):
+    current_set = set(current_items)
+    new_set = set(new_items)
+    return {
+        "append": [{"value": domain} for domain in new_items if domain not in current_set],
+        "remove": [domain for domain in current_items if domain not in new_set],
+    }
+
+def count_plan_items(plan):
+    items_appended = sum(len(payload["append"]) for list_item, payload in plan["patches"])
+    items_appended += sum(len(payload["items"]) for index, payload in plan["creates"])
+    items_removed = sum(len(payload["remove"]) for list_item, payload in plan["patches"])
+    return items_appended, items_removed
+
 def create_policy_json(name, used_list_ids):
     return {
         "name": name,
@@ -33,15 +71,16 @@ def create_policy_json(name, used_list_ids):
         "filters": ["dns"],
     }
 
-def get_missing_indices(existing_indices, total_lists):
-    all_indices = set(range(1, total_lists + 1))
-    missing_indices = list(all_indices - set(existing_indices))
-    missing_indices.sort()
-    return missing_indices
+def list_index(adlist_name, list_name):
+    # Index of a list named "<adlist_name> - 001", None for any other list.
+    # Other prefixes may contain digits or this one, so the whole name has
+    # to match.
+    match = re.fullmatch(rf"{re.escape(adlist_name)} - (\d+)", list_name)
+    return int(match.group(1)) if match else None
 
-def safe_sort_key(list_item):
-    match = re.search(r'\d+', list_item["name"])
-    return int(match.group()) if match else float('inf')
+def safe_sort_key(list_item, adlist_name):
+    index = list_index(adlist_name, list_item["name"])
+    return index if index is not None else float('inf')
 
 def hash_list(list_items):
     hash_object = hashlib.sha256()